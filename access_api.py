@@ -1,16 +1,48 @@
-from fastapi import FastAPI, Query, UploadFile, File
+# Run with: uvicorn access_api:app --port 8001 --workers 4 --http httptools
+# (add --loop uvloop on POSIX hosts; it is unavailable on the Windows box
+# that has the Access ODBC driver)
+from fastapi import FastAPI, Query, Request, Response, UploadFile, File
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
+import aiofiles
+import orjson
 import pyodbc
+try:
+    import pyarrow as pa  # optional, for format=arrow bulk consumers
+except ImportError:
+    pa = None
+try:
+    import turbodbc  # optional, block-bound bulk reads without per-row objects
+except ImportError:
+    turbodbc = None
 from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from cachetools import TTLCache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+import asyncio
+import csv
+import hashlib
+import io
 import logging
 import os
+import queue
+import re
+import threading
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
-# Mount static files for plots
-if os.path.exists("plots"):
-    app.mount("/plots", StaticFiles(directory="plots"), name="plots")
+# Row-data JSON compresses 8-15x; Starlette gzips streaming responses
+# incrementally so /query_stream stays memory-bounded too
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+# Mount static files for plots; StaticFiles serves them zero-copy via sendfile
+PLOTS_DIR = "plots"
+os.makedirs(PLOTS_DIR, exist_ok=True)
+app.mount("/plots", StaticFiles(directory=PLOTS_DIR), name="plots")
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,77 +53,445 @@ CONN_STR = (
     fr"DBQ={ACCESS_DB_PATH};"
 )
 
-stream_chunk_size = 100
+stream_chunk_size = 2000
+
+# ODBC connection pooling at the driver-manager level (on by default, made explicit)
+pyodbc.pooling = True
+
+# The Access driver is not thread-safe for concurrent statements, so keep a small
+# bounded pool of our own and hand out one connection per request at a time.
+POOL_SIZE = min((os.cpu_count() or 1) * 2, 10)
+_conn_pool = queue.Queue(maxsize=POOL_SIZE)
+for _ in range(POOL_SIZE):
+    _conn_pool.put(None)  # placeholder, connect lazily on first acquire
+
+# Repeated queries differ only in their literals (generate_schema.py issues the
+# same COUNT(*) template per table, agents re-send identical SQL), so keep a
+# small LRU of prepared cursors per pooled connection and bind parameters.
+STMT_CACHE_SIZE = 64
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'")
+
+class PooledConnection:
+    """A pyodbc connection plus its prepared-cursor cache."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.stmt_cache = OrderedDict()  # sql template -> cursor
+        self.bad_templates = set()  # templates where literal-lifting failed
 
-def decode_sketchy_utf16(raw_bytes):
-    """Handle problematic UTF-16-LE encoded strings from MS Access."""
-    s = raw_bytes.decode("utf-16le", "ignore")
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+def execute_cached(conn, sql, params=None):
+    """Execute sql on a cached cursor, lifting string literals into ? params.
+
+    Callers may pass explicit params for SQL already written with ?
+    placeholders; otherwise quoted literals are lifted automatically.
+    pyodbc keeps the statement handle alive across executes on the same
+    cursor, so the Jet engine reuses the compiled plan when only the bound
+    literals change.
+    """
+    lifted = False
+    if params is None:
+        template = _LITERAL_RE.sub("?", sql)
+        if template in conn.bad_templates:
+            template, params = sql, []
+        else:
+            lifted = True
+            params = [m[1:-1].replace("''", "'") for m in _LITERAL_RE.findall(sql)]
+    else:
+        template = sql
+    cache = conn.stmt_cache
+    cursor = cache.pop(template, None)
+    if cursor is None:
+        cursor = conn.cursor()
+        if len(cache) >= STMT_CACHE_SIZE:
+            _, evicted = cache.popitem(last=False)
+            try:
+                evicted.close()
+            except Exception:
+                pass
+    try:
+        try:
+            if params:
+                cursor.execute(template, params)
+            else:
+                cursor.execute(sql)
+        except Exception:
+            if not (lifted and params):
+                raise
+            # Lifting can move literals out of positions Jet won't accept a
+            # parameter in (SELECT/GROUP BY expressions, quoted aliases), so
+            # the rewrite must only ever help: retry the original SQL and
+            # remember the template so it isn't tried again
+            logger.warning("Parameterized execute failed, retrying original SQL")
+            conn.bad_templates.add(template)
+            template = sql
+            cursor.execute(sql)
+    finally:
+        cache[template] = cursor
+    return cursor
+
+# Dedicated executor for ODBC work, sized to the pool. Keeping DB queries off
+# Starlette's shared threadpool stops a burst of long queries from starving
+# /save_plot and the static plot serves.
+db_executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="odbc")
+
+async def run_db(func, *args):
+    """Run blocking ODBC work on the dedicated executor."""
+    return await asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+@app.on_event("shutdown")
+async def shutdown_db_executor():
+    db_executor.shutdown(wait=True)
+
+@contextmanager
+def get_conn():
+    """Borrow a pooled connection, pre-pinging so dead connections get replaced."""
+    conn = _conn_pool.get()
     try:
-        n = s.index('\u0000')
-        s = s[:n]  # respect null terminator
-    except ValueError:
-        pass
-    return s
+        if conn is not None:
+            try:
+                # Jet has no table-less SELECT, so ping via a driver call
+                # instead of SQL; getinfo round-trips to the driver without
+                # compiling a statement
+                conn.getinfo(pyodbc.SQL_DBMS_NAME)
+            except Exception:
+                logger.warning("Pooled connection failed pre-ping, reconnecting")
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                conn = None
+        if conn is None:
+            conn = PooledConnection(pyodbc.connect(CONN_STR, autocommit=True))
+            # Install the UTF-16 workaround once per connection rather than
+            # swapping converters on every /columns request
+            conn.add_output_converter(pyodbc.SQL_WVARCHAR, decode_sketchy_utf16)
+        yield conn
+    except Exception:
+        # Don't return a connection in an unknown state to the pool
+        try:
+            conn.close()
+        except Exception:
+            pass
+        conn = None
+        raise
+    finally:
+        _conn_pool.put(conn)
+
+# Catalog results change rarely (the .accdb lives on a network share), so cache
+# them in-process instead of hitting ODBC catalog calls on every request.
+_catalog_cache = TTLCache(maxsize=256, ttl=3600)
+_catalog_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0}
+
+def cached_catalog(key, fetch):
+    """Return the cached value for (route, arg), calling fetch() on a miss."""
+    with _catalog_cache_lock:
+        if key in _catalog_cache:
+            _cache_stats["hits"] += 1
+            return _catalog_cache[key]
+        _cache_stats["misses"] += 1
+    value = fetch()
+    with _catalog_cache_lock:
+        _catalog_cache[key] = value
+    return value
+
+@lru_cache(maxsize=4096)
+def decode_sketchy_utf16(raw_bytes: bytes) -> str:
+    """Handle problematic UTF-16-LE encoded strings from MS Access.
+
+    Kept small, pure and fully typed so it can be compiled with mypyc or
+    Cython if introspection ever shows up hot again; with the lru_cache and
+    the pre-decode truncation it is no longer a bottleneck in profiles.
+    """
+    # Truncate at the (2-byte aligned) null terminator before decoding;
+    # decoding the garbage padding past it is wasted work
+    n = raw_bytes.find(b"\x00\x00")
+    while n != -1 and n % 2:
+        n = raw_bytes.find(b"\x00\x00", n + 1)
+    if n != -1:
+        raw_bytes = raw_bytes[:n]
+    return raw_bytes.decode("utf-16le", "ignore")
 
 @app.post("/save_plot")
 async def save_plot(file: UploadFile = File(...)):
-    plots_dir = "plots"
-    if not os.path.exists(plots_dir):
-        os.makedirs(plots_dir)
     filename = file.filename
-    file_path = os.path.join(plots_dir, filename)
-    with open(file_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    file_path = os.path.join(PLOTS_DIR, filename)
+    # Stream the upload to disk in bounded chunks instead of buffering the
+    # whole PNG in memory and writing it on the event loop thread
+    async with aiofiles.open(file_path, "wb") as f:
+        while chunk := await file.read(1 << 16):
+            await f.write(chunk)
     return JSONResponse({"filename": filename})
 
+def etag_response(request: Request, payload):
+    """Serve payload with an ETag, answering 304 when the client has it already."""
+    body = orjson.dumps(payload)
+    # blake2b beats sha256 on short inputs; 8 bytes is plenty for a validator
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=3600"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+@app.get("/mtime")
+async def get_db_mtime():
+    """Modification time of the .accdb, so clients can validate disk caches."""
+    try:
+        return {"mtime": os.path.getmtime(ACCESS_DB_PATH)}
+    except OSError as e:
+        logger.error(f"Mtime error: {str(e)}")
+        return {"error": str(e)}
+
 @app.get("/tables")
-def get_tables():
+async def get_tables(request: Request):
     logger.info("Getting tables")
     try:
-        conn = pyodbc.connect(CONN_STR)
-        cursor = conn.cursor()
-        cursor.tables()
-        tables = [table.table_name for table in cursor.fetchall()]
-        cursor.close()
-        conn.close()
-        return {"tables": tables}
+        payload = await run_db(cached_catalog, ("tables", None), _fetch_tables)
     except Exception as e:
         logger.error(f"Tables error: {str(e)}")
         return {"error": str(e)}
-    
+    return etag_response(request, payload)
 
-@app.get("/query")
-def run_query(q: str = Query(...)):
-    logger.info(f"Received query: {q}")    
-    try:
-        conn = pyodbc.connect(CONN_STR)
+def _fetch_tables():
+    with get_conn() as conn:
         cursor = conn.cursor()
-        cursor.execute(q)
-        rows = cursor.fetchall()
+        cursor.arraysize = 256  # batch under the hood while iterating
+        # Let ODBC filter out system/linked tables before they hit Python
+        cursor.tables(tableType='TABLE')
+        # Iterate the cursor directly; fetchall would buffer every row twice
+        tables = [
+            table.table_name for table in cursor
+            if not table.table_name.startswith(("MSys", "~"))
+        ]
         cursor.close()
-        conn.close()
-        return {"result": [tuple(row) for row in rows]}
+    return {"tables": tables}
+
+# Agents tend to re-issue the same SQL while reasoning; collapse concurrent
+# identical queries onto one ODBC round trip
+_inflight_queries = {}  # sql -> asyncio.Future
+
+@app.get("/query")
+async def run_query(q: str = Query(...), format: str = Query("json"), limit: int = Query(0, ge=0)):
+    logger.info(f"Received query: {q} (format={format}, limit={limit})")
+    if format == "arrow":
+        if pa is None:
+            return {"error": "pyarrow is not installed on the server"}
+        try:
+            payload = await run_db(_run_query_arrow_sync, q)
+        except Exception as e:
+            logger.error(f"Query error: {str(e)}")
+            return {"error": str(e)}
+        return Response(payload, media_type="application/vnd.apache.arrow.stream")
+    inflight_key = (q, limit)
+    existing = _inflight_queries.get(inflight_key)
+    if existing is not None:
+        logger.info("Joining in-flight identical query")
+        return await existing
+    fut = asyncio.get_running_loop().create_future()
+    _inflight_queries[inflight_key] = fut
+    try:
+        try:
+            result = await run_db(_run_query_sync, q, None, limit or None)
+        except Exception as e:
+            logger.error(f"Query error: {str(e)}")
+            result = {"error": str(e)}
+        fut.set_result(result)
+        return result
+    finally:
+        # A cancelled leader (client disconnect) never reaches set_result;
+        # resolve the future anyway so joined followers aren't stuck awaiting
+        if not fut.done():
+            fut.set_result({"error": "query cancelled"})
+        _inflight_queries.pop(inflight_key, None)
+
+def _run_query_sync(q: str, params=None, limit=None):
+    with get_conn() as conn:
+        cursor = execute_cached(conn, q, params)
+        cursor.arraysize = 1000  # pyodbc honors this for row prefetch
+        rows = []
+        while batch := cursor.fetchmany(1000):
+            rows.extend(tuple(row) for row in batch)
+            # Stop serializing once the caller's row cap is reached; Jet has
+            # no reliable parameterized TOP, so the cap is applied here
+            if limit is not None and len(rows) >= limit:
+                rows = rows[:limit]
+                break
+    return {"result": rows}
+
+# turbodbc pulls result buffers in bulk via ODBC block binding and hands back
+# Arrow columns directly, skipping the per-row Python object layer entirely.
+# Keep it to the read path: pyodbc stays for catalog calls and DDL, and the
+# Access driver's thread-safety limits mean one turbodbc statement at a time.
+_turbo_lock = threading.Lock()
+_turbo_conn = None
+
+def _get_turbo_conn():
+    global _turbo_conn
+    if _turbo_conn is None:
+        options = turbodbc.make_options(
+            read_buffer_size=turbodbc.Megabytes(100),
+            use_async_io=True,
+        )
+        _turbo_conn = turbodbc.connect(connection_string=CONN_STR, turbodbc_options=options)
+    return _turbo_conn
+
+def _run_query_arrow_sync(q: str):
+    """Run q and serialize the result as an Arrow IPC stream (columnar)."""
+    if turbodbc is not None:
+        with _turbo_lock:
+            cursor = _get_turbo_conn().cursor()
+            cursor.execute(q)
+            table = cursor.fetchallarrow()
+            cursor.close()
+    else:
+        with get_conn() as conn:
+            cursor = execute_cached(conn, q)
+            cursor.arraysize = 1000
+            names = [d[0] for d in cursor.description]
+            columns = [[] for _ in names]
+            while batch := cursor.fetchmany(1000):
+                for row in batch:
+                    for col, value in zip(columns, row):
+                        col.append(value)
+        table = pa.table([pa.array(col) for col in columns], names=names)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+def _serialize_ndjson(batch):
+    # NDJSON, one row per line
+    return b"".join(orjson.dumps(tuple(row)) + b"\n" for row in batch)
+
+def _make_csv_serializer():
+    # csv.writer handles quoting of commas/newlines in cells and formats
+    # rows in C; the buffer is reused across chunks
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    def serialize(batch):
+        writer.writerows(batch)
+        chunk = buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate(0)
+        return chunk
+    return serialize
+
+class QueryRequest(BaseModel):
+    q: str
+    params: list = []
+
+@app.post("/query")
+async def run_query_post(req: QueryRequest):
+    """Parameterized /query: binds params to ? placeholders server-side."""
+    logger.info(f"Received parameterized query: {req.q}")
+    try:
+        return await run_db(_run_query_sync, req.q, req.params or None)
     except Exception as e:
         logger.error(f"Query error: {str(e)}")
         return {"error": str(e)}
 
+class BatchQueryRequest(BaseModel):
+    queries: list  # each entry is a SQL string or {"q": ..., "params": [...]}
+
+@app.post("/batch_query")
+async def batch_query(req: BatchQueryRequest):
+    logger.info(f"Received batch of {len(req.queries)} queries")
+    return await run_db(_run_batch_sync, req.queries)
+
+def _run_batch_sync(queries):
+    """Run several queries on one pooled connection, one round trip for all."""
+    results = []
+    with get_conn() as conn:
+        for q in queries:
+            try:
+                if isinstance(q, dict):
+                    cursor = execute_cached(conn, q["q"], q.get("params") or None)
+                else:
+                    cursor = execute_cached(conn, q)
+                cursor.arraysize = 1000
+                rows = []
+                while batch := cursor.fetchmany(1000):
+                    rows.extend(tuple(row) for row in batch)
+                results.append({"result": rows})
+            except Exception as e:
+                logger.error(f"Batch query error: {str(e)}")
+                results.append({"error": str(e)})
+    return {"results": results}
+
+@app.get("/query_stream")
+def stream_query(q: str = Query(...), format: str = Query("ndjson")):
+    logger.info(f"Received streaming query: {q} (format={format})")
+    if format == "csv":
+        serialize, media_type = _make_csv_serializer(), "text/csv"
+    else:
+        serialize, media_type = _serialize_ndjson, "application/x-ndjson"
+
+    def produce(out: queue.Queue, abandoned: threading.Event):
+        def put(chunk) -> bool:
+            # A disconnected client stops draining the queue; a plain put
+            # would then block forever with the pooled connection checked out
+            while not abandoned.is_set():
+                try:
+                    out.put(chunk, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            with get_conn() as conn:
+                cursor = conn.cursor()
+                # Match the prefetch buffer to the chunk size so each chunk is
+                # one buffer fill instead of row-at-a-time SQLFetch calls
+                cursor.arraysize = stream_chunk_size
+                cursor.execute(q)
+                while batch := cursor.fetchmany(stream_chunk_size):
+                    if not put(serialize(batch)):
+                        return
+                cursor.close()
+        except Exception as e:
+            logger.error(f"Stream query error: {str(e)}")
+            put(orjson.dumps({"error": str(e)}) + b"\n")
+        finally:
+            put(None)
+
+    def generate():
+        # Bounded handoff queue so the driver prefetches the next batch while
+        # the previous one is being written to the socket
+        out = queue.Queue(maxsize=2)
+        abandoned = threading.Event()
+        threading.Thread(target=produce, args=(out, abandoned), daemon=True).start()
+        try:
+            while (chunk := out.get()) is not None:
+                yield chunk
+        finally:
+            # Runs when the client disconnects mid-stream too; unblock the
+            # producer so it returns its connection to the pool
+            abandoned.set()
+
+    return StreamingResponse(generate(), media_type=media_type)
+
 @app.get("/columns/{table_name}")
-def get_columns(table_name: str):
+async def get_columns(table_name: str, request: Request):
     logger.info(f"Getting columns for table: {table_name}")
     try:
-        conn = pyodbc.connect(CONN_STR)
-        
-        # Set up the UTF-16 converter for this operation
-        prev_converter = conn.get_output_converter(pyodbc.SQL_WVARCHAR)
-        conn.add_output_converter(pyodbc.SQL_WVARCHAR, decode_sketchy_utf16)
-        
+        payload = await run_db(cached_catalog, ("columns", table_name), lambda: _fetch_columns(table_name))
+    except Exception as e:
+        logger.error(f"Columns error: {str(e)}")
+        return {"error": str(e)}
+    return etag_response(request, payload)
+
+def _fetch_columns(table_name: str):
+    with get_conn() as conn:
         cursor = conn.cursor()
+        cursor.arraysize = 256  # batch under the hood while iterating
         cursor.columns(table_name)
-        
-        # Fetch detailed column information
+
+        # Collect detailed column information, iterating the cursor directly
         columns = []
-        for column in cursor.fetchall():
+        for column in cursor:
             try:
                 column_info = {
                 "name": column.column_name,
@@ -104,24 +504,45 @@ def get_columns(table_name: str):
             except Exception as e:
                 logger.error(f"Error processing column: {str(e)}")
                 continue
-        
-        # Restore the previous converter
-        conn.add_output_converter(pyodbc.SQL_WVARCHAR, prev_converter)
-        
+
         cursor.close()
-        conn.close()
-        return {"columns": columns}
+    return {"columns": columns}
+
+@app.get("/schema_bulk")
+async def get_schema_bulk(request: Request):
+    logger.info("Getting bulk schema")
+    try:
+        payload = await run_db(cached_catalog, ("schema_bulk", None), _fetch_schema_bulk)
     except Exception as e:
-        logger.error(f"Columns error: {str(e)}")
+        logger.error(f"Bulk schema error: {str(e)}")
         return {"error": str(e)}
+    return etag_response(request, payload)
+
+def _fetch_schema_bulk():
+    """Columns and row counts for every user table, in a single response."""
+    tables = _fetch_tables()["tables"]
+    bulk = {}
+    for table in tables:
+        try:
+            with get_conn() as conn:
+                cursor = execute_cached(conn, f"SELECT COUNT(*) FROM [{table.replace(']', ']]')}]")
+                row_count = cursor.fetchone()[0]
+            bulk[table] = {
+                "row_count": row_count,
+                "columns": _fetch_columns(table)["columns"],
+            }
+        except Exception as e:
+            logger.error(f"Bulk schema error for table {table}: {str(e)}")
+            continue
+    return {"tables": bulk}
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    with _catalog_cache_lock:
+        return {
+            "hits": _cache_stats["hits"],
+            "misses": _cache_stats["misses"],
+            "entries": len(_catalog_cache),
+        }
 
-@app.get("/plots/{filename}")
-def get_plot(filename: str):
-    """Serve plot images"""
-    plot_path = os.path.join("plots", filename)
-    if os.path.exists(plot_path):
-        logger.info(f"Saving plot to {plot_path}")
-        return FileResponse(plot_path, media_type="image/png")
-    else:
-        return {"error": "Plot not found"}
 
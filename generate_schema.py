@@ -1,37 +1,85 @@
-import requests
+import asyncio
+import httpx
+import orjson
 import yaml
+try:
+    from yaml import CSafeDumper as SafeDumper  # libyaml, ~10x the pure-Python dumper
+except ImportError:
+    from yaml import SafeDumper
 from pathlib import Path
-from typing import List, Dict
-import time
+from typing import Dict, List, Tuple
 from tqdm import tqdm
 
-def get_tables() -> List[str]:
-    """Get all tables from the database"""
-    resp = requests.get("http://localhost:8001/tables")
-    tables = resp.json().get("tables", [])
-    # Filter out system tables
-    return [table for table in tables if not table.startswith("MSys")]
+API_BASE_URL = "http://localhost:8001"
+FETCH_CONCURRENCY = 16
 
-def get_columns(table_name: str) -> List[Dict]:
+async def get_tables(client: httpx.AsyncClient) -> List[str]:
+    """Get all tables from the database (the server filters system tables)"""
+    resp = await client.get("/tables")
+    return resp.json().get("tables", [])
+
+async def get_columns(client: httpx.AsyncClient, table_name: str) -> List[Dict]:
     """Get columns for a specific table"""
-    resp = requests.get(f"http://localhost:8001/columns/{table_name}")
+    resp = await client.get(f"/columns/{table_name}")
     return resp.json().get("columns", [])
 
-def get_row_count(table_name: str) -> int:
+def quote_identifier(name: str) -> str:
+    """Bracket-quote an Access identifier so reserved words like Order work"""
+    return "[" + name.replace("]", "]]") + "]"
+
+async def get_row_count(client: httpx.AsyncClient, table_name: str) -> int:
     """Get the row count for a specific table"""
-    resp = requests.get(f"http://localhost:8001/query/", params={"q": f"SELECT COUNT(*) FROM {table_name}"})
+    resp = await client.get("/query", params={"q": f"SELECT COUNT(*) FROM {quote_identifier(table_name)}"})
     return resp.json().get("result", [0])[0][0]
 
-def generate_schema_yaml():
-    """Generate the complete schema YAML file"""
+async def get_schema_bulk(client: httpx.AsyncClient) -> Dict:
+    """Get columns and row counts for every table in a single round trip"""
+    resp = await client.get("/schema_bulk", timeout=600)
+    return resp.json().get("tables", {})
+
+async def fetch_table(client: httpx.AsyncClient, sem: asyncio.Semaphore, table: str) -> Tuple[str, int, List[Dict]]:
+    """Fetch columns and row count for one table, bounded by the semaphore"""
+    async with sem:
+        columns, row_count = await asyncio.gather(
+            get_columns(client, table),
+            get_row_count(client, table),
+        )
+        return table, row_count, columns
+
+async def fetch_all_tables(client: httpx.AsyncClient) -> Dict[str, Dict]:
+    """Fetch the whole schema, preferring the bulk endpoint over per-table fan-out"""
+    try:
+        bulk = await get_schema_bulk(client)
+        if bulk:
+            return bulk
+    except Exception as e:
+        print(f"Bulk schema fetch failed ({e}), falling back to per-table requests")
+
     print("Fetching tables...")
-    tables = get_tables()
-    
+    tables = await get_tables(client)
+    print(f"Processing {len(tables)} tables...")
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    tasks = [fetch_table(client, sem, table) for table in tables]
+    results = {}
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+        try:
+            table, row_count, columns = await task
+            results[table] = {"row_count": row_count, "columns": columns}
+        except Exception as e:
+            print(f"Error processing table: {str(e)}")
+            continue
+    return results
+
+async def generate_schema_yaml():
+    """Generate the complete schema YAML file"""
+    async with httpx.AsyncClient(base_url=API_BASE_URL, timeout=60) as client:
+        tables_info = await fetch_all_tables(client)
+
     schema = {
         "database": {
             "name": "Bosda-BizLibrary",
             "version": "20250519",
-            "total_tables": len(tables)
+            "total_tables": len(tables_info)
         },
         "tables": {},
         "few_shot_examples": [
@@ -49,28 +97,24 @@ def generate_schema_yaml():
             }
         ]
     }
-    
-    print(f"Processing {len(tables)} tables...")
-    for table in tqdm(tables, total=len(tables)):
-        try:
-            row_count = get_row_count(table)
-            if row_count > 1:
-                columns = get_columns(table)
-
-                schema["tables"][table] = {
-                    "description": "",  # You can add descriptions manually later
-                    "columns": columns
-                }
-        except Exception as e:
-            print(f"Error processing table {table}: {str(e)}")
-            continue
-    
+
+    for table, info in tables_info.items():
+        if info.get("row_count", 0) > 1:
+            schema["tables"][table] = {
+                "description": "",  # You can add descriptions manually later
+                "columns": info.get("columns", [])
+            }
+
     output_path = Path("db_schema.yaml")
     with open(output_path, "w") as f:
-        yaml.dump(schema, f, default_flow_style=False, sort_keys=False)
-    
-    print(f"\nSchema saved to {output_path}")
+        yaml.dump(schema, f, Dumper=SafeDumper, default_flow_style=False, sort_keys=False)
+
+    # JSON copy for programmatic consumers; the YAML stays for human editing
+    json_path = Path("db_schema.json")
+    json_path.write_bytes(orjson.dumps(schema))
+
+    print(f"\nSchema saved to {output_path} (and {json_path})")
     print(f"Total tables processed: {len(schema['tables'])}")
 
 if __name__ == "__main__":
-    generate_schema_yaml() 
\ No newline at end of file
+    asyncio.run(generate_schema_yaml())
@@ -3,26 +3,152 @@ from langchain.tools import StructuredTool
 from pydantic import BaseModel, Field
 from langchain.agents import AgentExecutor, create_openai_tools_agent
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+import aiohttp
 import asyncio
-import requests
+import hashlib
 import json
+import logging
+import numpy as np
+import orjson
+import re
+import time
 import yaml
+from collections import OrderedDict
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml, ~10x the pure-Python loader
+except ImportError:
+    from yaml import SafeLoader
+from pathlib import Path
+
+_SCHEMA_TTL = 600
+_schema_cache = {"value": None, "at": 0.0}
+
+def load_schema() -> dict:
+    '''Load the table schemas, preferring the JSON copy over the YAML.
+
+    Cached in-process for 10 minutes; the schema only changes when
+    generate_schema.py is re-run.
+    '''
+    now = time.monotonic()
+    if _schema_cache["value"] is not None and now - _schema_cache["at"] < _SCHEMA_TTL:
+        return _schema_cache["value"]
+    json_path = Path("db_schema.json")
+    if json_path.exists():
+        tables = orjson.loads(json_path.read_bytes()).get("tables", {})
+    else:
+        with open("db_schema.yaml") as f:
+            tables = yaml.load(f, Loader=SafeLoader).get("tables", {})
+    _schema_cache["value"] = tables
+    _schema_cache["at"] = now
+    return tables
+
+def invalidate_schema_cache():
+    '''Force the next load_schema() to re-read from disk (after regeneration)'''
+    _schema_cache["value"] = None
+
+API_BASE_URL = "http://localhost:8001"
+
+logger = logging.getLogger(__name__)
+
+def _truncate(text: str, limit: int = 500) -> str:
+    return text if len(text) <= limit else text[:limit] + f"... ({len(text)} chars)"
+
+# One keep-alive session for the whole agent run; the reasoning loop fires many
+# small calls and a per-call client paid a TCP handshake for each. Built lazily
+# so it lands on the running event loop.
+_SESSION = None
+
+async def get_session() -> aiohttp.ClientSession:
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=15),
+        )
+    return _SESSION
+
+async def close_session():
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+
+class QueryCache:
+    '''Answer cache for whole agent runs, keyed on the normalized question.
+
+    Exact hits are a dict lookup; with an embedding function, near-duplicate
+    questions match by cosine similarity. Answers depend on the data, so the
+    key includes a schema token the caller derives from the loaded schema.
+    '''
+    def __init__(self, maxsize: int = 256, embed_fn=None, threshold: float = 0.95):
+        self.maxsize = maxsize
+        self.embed_fn = embed_fn
+        self.threshold = threshold
+        self.entries = OrderedDict()  # (schema_token, normalized) -> (embedding, response)
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return re.sub(r"\s+", " ", query.lower().strip())
+
+    def _embed(self, text: str):
+        if self.embed_fn is None:
+            return None
+        try:
+            return np.asarray(self.embed_fn(text))
+        except Exception as e:
+            print(f"⚠️ Embedding failed, exact-match cache only: {e}")
+            return None
+
+    def get(self, query: str, schema_token: str = ""):
+        key = (schema_token, self.normalize(query))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key][1]
+        if self.entries:
+            target = self._embed(key[1])
+            if target is not None:
+                for (other_token, _), (emb, response) in self.entries.items():
+                    if other_token != schema_token or emb is None:
+                        continue
+                    sim = float(target @ emb / (np.linalg.norm(target) * np.linalg.norm(emb)))
+                    if sim >= self.threshold:
+                        return response
+        return None
+
+    def put(self, query: str, response, schema_token: str = ""):
+        key = (schema_token, self.normalize(query))
+        self.entries[key] = (self._embed(key[1]), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+try:
+    from langchain_ollama import OllamaEmbeddings
+    _embed_fn = OllamaEmbeddings(model="nomic-embed-text").embed_query
+except Exception:
+    _embed_fn = None
+
+query_cache = QueryCache(maxsize=256, embed_fn=_embed_fn)
 
 class db_query_spec(BaseModel):
     query: str = Field(..., description="The syntatically correct Microsoft Access Database query to run on the database")
 
-def db_query(query: str) -> str:
-    '''Run a query on the database''' 
+async def db_query(query: str) -> str:
+    '''Run a query on the database'''
     print(f"\n🔍 Executing query: {query}")
-    resp = requests.get(f"http://localhost:8001/query", params={"q": query})
-    result = resp.json()
+    session = await get_session()
+    async with session.get(f"{API_BASE_URL}/query", params={"q": query}) as resp:
+        # orjson parses the raw bytes directly, skipping aiohttp's
+        # decode + stdlib json path on large result sets
+        result = orjson.loads(await resp.read())
     print(f"📊 Query result: {result}")
     return result
 
+# Registered with coroutine= so AgentExecutor.ainvoke runs tool calls on the
+# event loop; when the model emits several calls in one turn, the executor
+# gathers them concurrently instead of awaiting each in sequence
 db_query_tool = StructuredTool.from_function(
     name="db_query",
     description="Run a query on the database. The query must be syntatically correct and return a result.",
-    func=db_query,
+    coroutine=db_query,
     args_schema=db_query_spec
 )
 
@@ -30,6 +156,10 @@ chat = ChatOllama(
     model="qwen3",
     temperature=0,
     seed=42,
+    # Keep the model resident between calls so llama.cpp can reuse the KV
+    # cache for the byte-identical [system+schema] prefix instead of
+    # re-prefilling it every invocation
+    keep_alive="1h",
 )
 
 
@@ -55,23 +185,33 @@ Here is the schema of the database, including all tables and columns in each tab
 Do not hallucinate and make up information.
 """
 
+# Bake the schema in once at import: it is static for the life of the process,
+# and partial() keeps any braces inside the schema text from being treated as
+# template variables. Inlining it also drops the per-invocation schema input.
+SCHEMA_STR = yaml.safe_dump(load_schema(), sort_keys=False)
+
 prompt = ChatPromptTemplate.from_messages([
     ("system", system_prompt),
     ("human", "{input}"),
     MessagesPlaceholder(variable_name="agent_scratchpad"),
-])
+]).partial(schema=SCHEMA_STR)
 
 # Create the agent with callbacks
 class VerboseAgent(AgentExecutor):
     async def _acall(self, inputs: dict, run_manager=None) -> dict:
-        print("\n🤖 Agent received input:", json.dumps(inputs, indent=2))
+        # Pretty-printing full inputs/outputs via json.dumps is pure overhead
+        # when nobody is reading it; only serialize at DEBUG, and truncated
+        debug = logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            logger.debug("🤖 Agent received input: %s", _truncate(json.dumps(inputs, indent=2)))
         try:
             result = await super()._acall(inputs, run_manager)
-            print("\n✅ Agent execution completed")
-            print("📤 Final output:", json.dumps(result, indent=2))
+            if debug:
+                logger.debug("✅ Agent execution completed")
+                logger.debug("📤 Final output: %s", _truncate(json.dumps(result, indent=2, default=str)))
             return result
         except Exception as e:
-            print(f"\n❌ Agent execution failed: {str(e)}")
+            logger.error("❌ Agent execution failed: %s", e)
             raise
 
 agent = create_openai_tools_agent(chat, [db_query_tool], prompt)
@@ -90,11 +230,18 @@ async def main():
     print("\n🚀 Starting agent execution...")
     print("📋 Available tools:", [tool.name for tool in agent_executor.tools])
 
-    schema = yaml.safe_load(open("db_schema.yaml")).get("tables", {})
-    
     query = "according to the ProductApplication_ACES table, how many car models fit the part with item_id 513001? and what are the car models?"
-    response = await agent_executor.ainvoke({"input": query, "schema": schema})
-    print(f"\n🔍 Response: {response}")
+    schema_token = hashlib.blake2b(SCHEMA_STR.encode()).hexdigest()[:16]
+    cached = query_cache.get(query, schema_token)
+    if cached is not None:
+        print(f"\n🔍 Response (cached): {cached}")
+        return
+    try:
+        response = await agent_executor.ainvoke({"input": query})
+        query_cache.put(query, response, schema_token)
+        print(f"\n🔍 Response: {response}")
+    finally:
+        await close_session()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -2,12 +2,11 @@
 name: MS Access Query via API
 description: A pipeline to query Microsoft Access .accdb files using a FastAPI server and HTTP requests.
 mode: python
-requirements: aiohttp
+requirements: requests
 """
 
 from typing import List, Union, Generator, Iterator
-import aiohttp
-import asyncio
+import requests
 
 class Pipeline:
     def __init__(self):
@@ -19,43 +18,18 @@ class Pipeline:
     async def on_shutdown(self):
         print(f"on_shutdown:{__name__}")
 
-    async def fetch_query_result(self, query: str) -> str:
-        url = "http://host.docker.internal:8001/query"
-        params = {"q": query}
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, timeout=15) as resp:
-                    data = await resp.json()
-                    if "result" in data:
-                        return f"✅ Results:\n{data['result']}"
-                    else:
-                        return f"❌ Error:\n{data.get('error', 'Unknown error')}"
-        except Exception as e:
-            return f"❌ Request failed: {str(e)}"
-        
-    async def fetch_query_stream(self, query: str) -> str:
-        url = "http://host.docker.internal:8001/query_stream"
-        params = {"q": query}
-
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, params=params, timeout=60) as resp:
-                    if resp.status != 200:
-                        return f"❌ Server returned error code {resp.status}"
-                    
-                    output = ""
-                    async for line in resp.content:
-                        # Decode bytes and append
-                        output += line.decode("utf-8")
-                    
-                    return f"✅ Results (streamed):\n{output}"
-        except Exception as e:
-            return f"❌ Request failed: {str(e)}"
-
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
+        # Stream rows to the UI as they arrive instead of buffering the whole
+        # result set into one string
+        url = "http://host.docker.internal:8001/query_stream"
         try:
-            result = asyncio.run(self.fetch_query_result(user_message))
-            return str(result)
+            with requests.get(url, params={"q": user_message}, stream=True, timeout=60) as resp:
+                if resp.status_code != 200:
+                    yield f"❌ Server returned error code {resp.status_code}"
+                    return
+                yield "✅ Results (streamed):\n"
+                for line in resp.iter_lines():
+                    if line:
+                        yield line.decode("utf-8") + "\n"
         except Exception as e:
-            return f"Error: {str(e)}"
-
+            yield f"❌ Request failed: {str(e)}"
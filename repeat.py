@@ -1,5 +1,5 @@
-from typing import List, Union, Generator, Iterator
-import time
+from typing import AsyncGenerator, List, Union
+import asyncio
 
 class Pipeline:
     def __init__(self):
@@ -17,11 +17,13 @@ class Pipeline:
         pass
 
     
-    def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
+    async def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, AsyncGenerator]:
         # This function is called when a new user_message is receieved.
-        
+
         print(f"received message from user: {user_message}") #user_message to logs
         yield (f"received message from user: {user_message}\n") #user_message to the UI
-        time.sleep(1)
+        # asyncio.sleep yields the event loop to other requests; time.sleep
+        # would block the whole worker for the duration
+        await asyncio.sleep(1)
         yield (f"received message from user: {user_message}\n") #user_message to the UI
         
\ No newline at end of file
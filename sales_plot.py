@@ -1,42 +1,67 @@
 """
-requirements: requests, pandas, matplotlib
+requirements: requests, pandas, matplotlib, orjson
 """
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import singledispatch
 from typing import List, Union, Generator, Iterator
 import pandas as pd
-import matplotlib.pyplot as plt
+import matplotlib
+matplotlib.use("Agg")  # headless server; skip the GUI backend machinery
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.gridspec import GridSpec
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import hashlib
+import numpy as np
+import orjson
 import re
 from datetime import datetime
 import os
+import threading
 import uuid
 import io
 import matplotlib.ticker as mticker
 
+# Common patterns for part numbers, compiled once as one alternation so the
+# message is scanned a single time (adjust based on your format):
+# 6+ digit numbers, letters+digits, digits+letters, "part: ABC123"/"item ABC123"
+_PART_NUMBER_RE = re.compile(
+    r'(\b\d{6,}\b)'
+    r'|(\b[A-Z]{2,}\d{3,}\b)'
+    r'|(\b\d{3,}[A-Z]{1,3}\b)'
+    r'|part[:\s]*([A-Z0-9-]+)'
+    r'|item[:\s]*([A-Z0-9-]+)',
+    re.IGNORECASE,
+)
+
+@singledispatch
 def stream(response):
-    """Stream Ollama API response, extracting content from JSON"""
-    if isinstance(response, str):
-        yield response
-    elif hasattr(response, 'iter_lines'):  # Ollama response
-        for line in response.iter_lines():
-            if line:
-                line_str = line.decode('utf-8')
-                if line_str.strip():
-                    try:
-                        data = json.loads(line_str)
-                        if 'message' in data and 'content' in data['message']:
-                            yield data['message']['content']
-                    except json.JSONDecodeError:
-                        continue
-    elif isinstance(response, (Generator, Iterator)):
-        for chunk in response:
-            yield chunk
-    elif hasattr(response, '__iter__'):
-        for chunk in response:
-            yield chunk
+    """Stream a response, dispatching on its type instead of isinstance chains"""
+    if hasattr(response, '__iter__'):
+        yield from response
     else:
         yield str(response)
 
+@stream.register
+def _(response: str):
+    yield response
+
+@stream.register
+def _(response: requests.Response):
+    # Ollama response: parse each NDJSON line as bytes -- orjson takes bytes
+    # directly, so the per-line utf-8 decode is skipped entirely
+    for line in response.iter_lines():
+        if line:
+            try:
+                data = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if 'message' in data and 'content' in data['message']:
+                yield data['message']['content']
+
 def auto_stream(func):
     """Decorator to automatically stream the result"""
     def wrapper(*args, **kwargs):
@@ -54,7 +79,32 @@ class Pipeline:
         self.name = "Plot Sales Data"
         self.api_base_url = "http://host.docker.internal:8001"  # For backend API calls
         self.image_base_url = "http://10.10.12.30:8001"  # For browser image links (LAN IP)
-        
+
+        # Keep-alive session so queries and plot uploads reuse connections
+        # instead of paying a TCP handshake per call
+        self.http = requests.Session()
+        self.http.mount("http://", HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=Retry(total=2, backoff_factor=0.1),
+        ))
+
+        # One Figure reused for every plot: allocating a 16x12 canvas and its
+        # Agg buffers per request is the expensive part, clearing it is not.
+        # Figures aren't thread-safe, so a lock serializes concurrent pipes.
+        self.fig = Figure(figsize=(16, 12))
+        FigureCanvasAgg(self.fig)
+        self.fig_lock = threading.Lock()
+
+        # Plot uploads happen off the request path; the filename is known
+        # before the upload finishes, so the caller need not wait for it
+        self.upload_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="plot-upload")
+
+        # Rendered-plot memo: identical rollup data produces an identical PNG,
+        # so repeat questions about the same part reuse the uploaded file
+        self.plot_cache = OrderedDict()  # (part_number, data_digest) -> filename
+        self.plot_cache_size = 128
+
         # Create plots directory if it doesn't exist
         self.plots_dir = "plots"
         print(f"[DEBUG] Checking/creating plots directory at: {os.path.abspath(self.plots_dir)}")
@@ -77,43 +127,57 @@ class Pipeline:
         pass
 
     def extract_part_number(self, user_message: str) -> str:
-        """Extract part number from user message using regex patterns"""
-        # Common patterns for part numbers (adjust based on your format)
-        patterns = [
-            r'\b\d{6,}\b',  # 6+ digit numbers
-            r'\b[A-Z]{2,}\d{3,}\b',  # Letters followed by numbers
-            r'\b\d{3,}[A-Z]{1,3}\b',  # Numbers followed by letters
-            r'part[:\s]*([A-Z0-9-]+)',  # "part: ABC123" or "part ABC123"
-            r'item[:\s]*([A-Z0-9-]+)',  # "item: ABC123" or "item ABC123"
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, user_message, re.IGNORECASE)
-            if match:
-                # If the pattern has a group, use it, otherwise use the whole match
-                return match.group(1) if match.groups() else match.group(0)
-        
+        """Extract part number from user message using a precompiled pattern"""
+        m = _PART_NUMBER_RE.search(user_message)
+        if m:
+            # Whichever alternative matched carries the part number
+            return next(g for g in m.groups() if g)
         return None
 
-    def query_sales_dates(self, part_number: str) -> dict:
-        """Query the database for sales order dates, quantities, and customer IDs for a given part number"""
+    def query_sales_rollups(self, part_number: str) -> dict:
+        """Query pre-aggregated sales rollups for a part number in one batched round trip.
+
+        Access does the GROUP BYs, so O(groups) rows come over the wire instead
+        of every raw order row.
+        """
+        # Bound via ? placeholders: no escaping/injection concerns, and the
+        # server's statement cache reuses one compiled plan per query shape
+        where = "WHERE [item_id] = ?"
+        params = [str(part_number)]
+        queries = [
+            # Monthly quantity per customer (stacked bar chart)
+            {"q": f"SELECT Format([so_date],'yyyy-mm'), [cust_id], SUM([qty]) FROM SOJournal {where} GROUP BY Format([so_date],'yyyy-mm'), [cust_id]", "params": params},
+            # Per-customer totals and order counts (pie chart, repeat buyers)
+            {"q": f"SELECT [cust_id], SUM([qty]), COUNT(*) FROM SOJournal {where} GROUP BY [cust_id]", "params": params},
+            # Per-quarter totals
+            {"q": f"SELECT Year([so_date]), DatePart('q',[so_date]), SUM([qty]) FROM SOJournal {where} GROUP BY Year([so_date]), DatePart('q',[so_date])", "params": params},
+            # Per-year totals
+            {"q": f"SELECT Year([so_date]), SUM([qty]) FROM SOJournal {where} GROUP BY Year([so_date])", "params": params},
+            # Overall date span and total quantity
+            {"q": f"SELECT MIN([so_date]), MAX([so_date]), SUM([qty]) FROM SOJournal {where}", "params": params},
+        ]
+        print(f"[DEBUG] Running batched rollup queries for part {part_number}")
         try:
-            # Construct the SQL query to get so_date, qty, and cust_id
-            query = f"SELECT so_date, qty, cust_id FROM SOJournal WHERE item_id = '{part_number}'"
-            print(f"[DEBUG] Running query: {query}")
-            # Make request to access_api.py endpoint
-            response = requests.get(f"{self.api_base_url}/query", params={"q": query})
-            print(f"[DEBUG] Query response status: {response.status_code}")
-            if response.status_code == 200:
-                result = response.json()
-                print(f"[DEBUG] Query result: {result}")
-                if "error" in result:
-                    return {"error": f"Database error: {result['error']}"}
-                return {"success": True, "data": result.get("result", [])}
-            else:
+            response = self.http.post(f"{self.api_base_url}/batch_query", json={"queries": queries})
+            print(f"[DEBUG] Batch query response status: {response.status_code}")
+            if response.status_code != 200:
                 print(f"[DEBUG] API request failed with status {response.status_code}")
                 return {"error": f"API request failed with status {response.status_code}"}
-                
+            # Parse the raw bytes with orjson; rollup payloads are small but
+            # the batch response is on every plot's critical path
+            results = orjson.loads(response.content).get("results", [])
+            for result in results:
+                if "error" in result:
+                    return {"error": f"Database error: {result['error']}"}
+            monthly, customers, quarterly, yearly, span = [r.get("result", []) for r in results]
+            return {
+                "success": True,
+                "monthly": monthly,
+                "customers": customers,
+                "quarterly": quarterly,
+                "yearly": yearly,
+                "span": span,
+            }
         except Exception as e:
             print(f"[DEBUG] Query exception: {str(e)}")
             return {"error": f"Query failed: {str(e)}"}
@@ -125,51 +189,49 @@ class Pipeline:
             print(f"[DEBUG] Error in sales data: {sales_data['error']}")
             return f"❌ Error: {sales_data['error']}"
         
-        data = sales_data.get("data", [])
-        print(f"[DEBUG] Data for DataFrame: {data}")
-        if not data:
+        # Same part + same rollup data means the same plot; skip the render
+        # and upload entirely on a hit
+        data_digest = hashlib.blake2b(orjson.dumps(sales_data, default=str), digest_size=16).hexdigest()
+        cache_key = (str(part_number), data_digest)
+        if cache_key in self.plot_cache:
+            self.plot_cache.move_to_end(cache_key)
+            print(f"[DEBUG] Plot cache hit for part {part_number}")
+            return self.plot_cache[cache_key]
+
+        monthly = sales_data.get("monthly", [])
+        print(f"[DEBUG] Monthly rollup rows: {monthly}")
+        if not monthly:
             print(f"[DEBUG] No sales orders found for this part number.")
             return "📊 No sales orders found for this part number."
-        
-        # Convert data to DataFrame with so_date, qty, and cust_id columns
-        df = pd.DataFrame(data, columns=['so_date', 'qty', 'cust_id'])
-        print(f"[DEBUG] DataFrame created: {df}")
-        
-        # Convert dates to datetime, qty to numeric, and fill missing cust_id
-        df['so_date'] = pd.to_datetime(df['so_date'], errors='coerce')
-        df['qty'] = pd.to_numeric(df['qty'], errors='coerce').fillna(0)
-        df['cust_id'] = df['cust_id'].fillna('Unknown').astype(str)
-        print(f"[DEBUG] DataFrame after conversions: {df}")
-        
-        # Remove rows with invalid dates
-        df = df.dropna(subset=['so_date'])
-        print(f"[DEBUG] DataFrame after dropping NA: {df}")
-        
-        if df.empty:
+
+        # The rollups arrive pre-aggregated from Access, so the plot inputs are
+        # built directly from O(groups) rows -- no client-side groupbys
+        monthly_df = pd.DataFrame(monthly, columns=['month', 'cust_id', 'qty'])
+        monthly_df['month'] = pd.to_datetime(monthly_df['month'], errors='coerce')
+        monthly_df['qty'] = pd.to_numeric(monthly_df['qty'], errors='coerce').fillna(0)
+        monthly_df['cust_id'] = monthly_df['cust_id'].fillna('Unknown').astype(str)
+        monthly_df = monthly_df.dropna(subset=['month'])
+
+        if monthly_df.empty:
             print(f"[DEBUG] No valid sales order dates found for this part number.")
             return "📊 No valid sales order dates found for this part number."
-        
-        # Sort by date
-        df = df.sort_values('so_date')
-        print(f"[DEBUG] DataFrame after sorting: {df}")
-        
-        # Group by date and sum qty for each date
-        daily_qty = df.groupby('so_date')['qty'].sum()
-        print(f"[DEBUG] Daily quantity grouped: {daily_qty}")
-        
-        # Group by customer and sum qty for each customer
-        customer_qty = df.groupby('cust_id')['qty'].sum().sort_values(ascending=False)
-        print(f"[DEBUG] Customer quantity grouped: {customer_qty}")
-        
+
+        # Per-customer totals and order counts, straight from the rollup
+        customers_df = pd.DataFrame(sales_data.get("customers", []), columns=['cust_id', 'qty', 'orders'])
+        customers_df['cust_id'] = customers_df['cust_id'].fillna('Unknown').astype(str)
+        customer_qty = customers_df.set_index('cust_id')['qty'].sort_values(ascending=False)
+        customer_order_counts = customers_df.set_index('cust_id')['orders']
+        print(f"[DEBUG] Customer quantity rollup: {customer_qty}")
+
         # Top 5 customers by quantity
         top_customers = customer_qty.head(5)
         top_customers_str = ', '.join([f"{cust}: {int(qty)}" for cust, qty in top_customers.items()])
-        
-        # Prepare monthly, customer-segmented data for the stacked bar chart
-        df['month'] = df['so_date'].dt.to_period('M').dt.to_timestamp()
-        monthly_customer_qty = df.groupby(['month', 'cust_id'])['qty'].sum().unstack(fill_value=0)
+
+        # Monthly, customer-segmented data for the stacked bar chart
+        monthly_customer_qty = monthly_df.pivot_table(
+            index='month', columns='cust_id', values='qty', aggfunc='sum', fill_value=0)
         # Ensure all months in the range are present, even if there are no sales
-        all_months = pd.date_range(df['month'].min(), df['month'].max(), freq='MS')
+        all_months = pd.date_range(monthly_df['month'].min(), monthly_df['month'].max(), freq='MS')
         monthly_customer_qty = monthly_customer_qty.reindex(all_months, fill_value=0)
         monthly_customer_qty.index.name = 'month'
         print(f"[DEBUG] Monthly customer quantity (with all months): {monthly_customer_qty}")
@@ -188,104 +250,123 @@ class Pipeline:
         pie_labels = pie_data.index
         pie_values = pie_data.values
         
-        # Create the plot in memory with the new layout
-        fig = plt.figure(figsize=(16, 12))
-        gs = plt.GridSpec(2, 2, height_ratios=[1, 1], width_ratios=[2, 1], hspace=0.45, wspace=0.25)  # Increased hspace for more vertical spacing
-        # Top half: Stacked bar chart (histogram)
-        ax1 = fig.add_subplot(gs[0, :])
-        bars = monthly_customer_qty.plot(kind='bar', stacked=True, ax=ax1, colormap='tab20', width=1.0, legend=False)
-        total_monthly_sales = monthly_customer_qty.sum(axis=1)
-        ax1.plot(range(len(total_monthly_sales)), total_monthly_sales, color='black', marker='o', linestyle='-', linewidth=2, label='Total Sales')
-        ax1.set_title(f'Monthly Sales Quantity Distribution by Customer for Part {part_number}', fontsize=16, fontweight='bold', pad=12)
-        ax1.set_xlabel('Month', fontsize=13)
-        ax1.set_ylabel('Total Quantity Ordered', fontsize=13)
-        ax1.set_xticks(range(len(month_labels)))
-        ax1.set_xticklabels(month_labels, rotation=30, ha='right')
-        ax1.legend(title='Customer', bbox_to_anchor=(1.01, 1), loc='upper left')
-        ax1.grid(True, alpha=0.3)
-        ax1.yaxis.set_major_locator(mticker.MaxNLocator(integer=True))
-        for i, month in enumerate(monthly_customer_qty.index):
-            bottom = 0
-            for j, cust in enumerate(monthly_customer_qty.columns):
-                qty = monthly_customer_qty.loc[month, cust]
-                if qty > 0:
-                    ax1.text(i, bottom + qty / 2, f'{int(qty)}', ha='center', va='center', fontsize=9, color='black', rotation=0)
-                bottom += qty
-        # Bottom left: Pie chart
-        ax2 = fig.add_subplot(gs[1, 0])
-        wedges, texts, autotexts = ax2.pie(
-            pie_values,
-            labels=pie_labels,
-            autopct='%1.1f%%',
-            startangle=90,
-            colors=plt.get_cmap('tab20').colors,
-            textprops={'fontsize': 10, 'fontfamily': 'DejaVu Sans', 'color': '#222'},
-            labeldistance=1.15,   # Move labels outward
-            pctdistance=0.75      # Move percentages closer to edge
-        )
-        for t in texts + autotexts:
-            t.set_fontsize(11)
-            t.set_fontfamily('DejaVu Sans')
-            t.set_color('#222')
-        ax2.set_title(f'Top Customers by Quantity for Part {part_number}', fontsize=14, fontweight='bold', pad=10)
-        # Calculate repeat buyers vs. one-time buyers
-        customer_order_counts = df.groupby('cust_id').size()
-        repeat_buyers = (customer_order_counts > 1).sum()
-        one_time_buyers = (customer_order_counts == 1).sum()
-        repeat_buyer_str = f"Repeat Buyers: {repeat_buyers} | One-time Buyers: {one_time_buyers}"
-        # Bottom right: Text summary
-        ax3 = fig.add_subplot(gs[1, 1])
-        ax3.axis('off')
-        total_qty = daily_qty.sum()
-        date_range = f"{df['so_date'].min().strftime('%Y-%m-%d')} to {df['so_date'].max().strftime('%Y-%m-%d')}"
-        summary_lines = [
-            f"Total Quantity: {total_qty}",
-            f"Date Range: {date_range}",
-            f"Top 5 Customers: {top_customers_str}",
-            f"{repeat_buyer_str}",
-        ]
-        df['quarter'] = df['so_date'].dt.to_period('Q').dt.to_timestamp()
-        df['year'] = df['so_date'].dt.year
-        quarterly_sales = df.groupby('quarter')['qty'].sum()
-        yearly_sales = df.groupby('year')['qty'].sum()
-        # Format quarterly sales as 'YYYY-QN'
-        def format_quarter(q):
-            if hasattr(q, 'year') and hasattr(q, 'quarter'):
-                return f"{q.year}-Q{q.quarter}"
-            return str(q)
-        quarterly_sales_str = ' | '.join([f"{format_quarter(q)}: {int(qty)}" for q, qty in quarterly_sales.items()])
-        yearly_sales_str = ' | '.join([f"{int(y)}: {int(qty)}" for y, qty in yearly_sales.items()])
-        summary_lines.append(f'Quarterly Sales: {quarterly_sales_str}')
-        summary_lines.append(f'Yearly Sales: {yearly_sales_str}')
-        # Join all lines into a single string, each on a new line
-        summary_text = '\n'.join(summary_lines)
-        import textwrap
-        wrapped_lines = []
-        for line in summary_lines:
-            wrapped_lines.extend(textwrap.wrap(line, width=45))
-        wrapped_text = '\n'.join(wrapped_lines)
-        # Calculate right margin in axes coordinates for 1 inch
-        fig_width_inch = fig.get_figwidth()
-        right_margin_frac = 1.0 - (1.0 / fig_width_inch)
-        ax3.set_xlim(0, right_margin_frac)
-        bbox_props = dict(facecolor='white', alpha=0.8, edgecolor='none', boxstyle='round,pad=0.3')
-        ax3.text(0, 1, wrapped_text, fontsize=13, fontfamily='DejaVu Sans', color='#222', ha='left', va='top', fontweight='bold', bbox=bbox_props, transform=ax3.transAxes, clip_on=False)
-        plt.tight_layout(rect=[0, 0, 1, 1])
-        filename = f"sales_plot_{part_number}_{uuid.uuid4().hex[:8]}.png"
-        buf = io.BytesIO()
-        plt.savefig(buf, format='png', dpi=300, bbox_inches='tight')
-        plt.close()
-        buf.seek(0)
-        # POST to backend
-        files = {'file': (filename, buf, 'image/png')}
-        response = requests.post(f"{self.api_base_url}/save_plot", files=files)
-        if response.status_code == 200:
-            result = response.json()
-            print(f"[DEBUG] Uploaded plot, backend returned filename: {result['filename']}")
-            return result["filename"]
-        else:
-            print(f"[DEBUG] Failed to upload plot: {response.text}")
-            return None
+        # Draw into the shared Figure under the lock; the explicit Figure +
+        # Agg canvas avoids pyplot's global figure manager
+        with self.fig_lock:
+            fig = self.fig
+            fig.clf()
+            gs = GridSpec(2, 2, height_ratios=[1, 1], width_ratios=[2, 1], hspace=0.45, wspace=0.25)  # Increased hspace for more vertical spacing
+            # Top half: Stacked bar chart (histogram)
+            ax1 = fig.add_subplot(gs[0, :])
+            bars = monthly_customer_qty.plot(kind='bar', stacked=True, ax=ax1, colormap='tab20', width=1.0, legend=False)
+            total_monthly_sales = monthly_customer_qty.sum(axis=1)
+            ax1.plot(range(len(total_monthly_sales)), total_monthly_sales, color='black', marker='o', linestyle='-', linewidth=2, label='Total Sales')
+            ax1.set_title(f'Monthly Sales Quantity Distribution by Customer for Part {part_number}', fontsize=16, fontweight='bold', pad=12)
+            ax1.set_xlabel('Month', fontsize=13)
+            ax1.set_ylabel('Total Quantity Ordered', fontsize=13)
+            ax1.set_xticks(range(len(month_labels)))
+            ax1.set_xticklabels(month_labels, rotation=30, ha='right')
+            ax1.legend(title='Customer', bbox_to_anchor=(1.01, 1), loc='upper left')
+            ax1.grid(True, alpha=0.3)
+            ax1.yaxis.set_major_locator(mticker.MaxNLocator(integer=True))
+            # Compute all label positions in one numpy pass instead of a
+            # .loc lookup per cell, and skip segments too thin to read
+            arr = monthly_customer_qty.to_numpy()
+            centers = np.cumsum(arr, axis=1) - arr / 2
+            min_visible = max(total_monthly_sales.max() * 0.02, 1)
+            for i, j in np.argwhere(arr >= min_visible):
+                ax1.text(i, centers[i, j], f'{int(arr[i, j])}', ha='center', va='center', fontsize=9, color='black', rotation=0)
+            # Bottom left: Pie chart
+            ax2 = fig.add_subplot(gs[1, 0])
+            wedges, texts, autotexts = ax2.pie(
+                pie_values,
+                labels=pie_labels,
+                autopct='%1.1f%%',
+                startangle=90,
+                colors=matplotlib.colormaps['tab20'].colors,
+                textprops={'fontsize': 10, 'fontfamily': 'DejaVu Sans', 'color': '#222'},
+                labeldistance=1.15,   # Move labels outward
+                pctdistance=0.75      # Move percentages closer to edge
+            )
+            for t in texts + autotexts:
+                t.set_fontsize(11)
+                t.set_fontfamily('DejaVu Sans')
+                t.set_color('#222')
+            ax2.set_title(f'Top Customers by Quantity for Part {part_number}', fontsize=14, fontweight='bold', pad=10)
+            # Calculate repeat buyers vs. one-time buyers
+            repeat_buyers = (customer_order_counts > 1).sum()
+            one_time_buyers = (customer_order_counts == 1).sum()
+            repeat_buyer_str = f"Repeat Buyers: {repeat_buyers} | One-time Buyers: {one_time_buyers}"
+            # Bottom right: Text summary
+            ax3 = fig.add_subplot(gs[1, 1])
+            ax3.axis('off')
+            # Totals and date span from the single-row rollup
+            span = sales_data.get("span", [])
+            min_date, max_date, total_qty = span[0] if span else (None, None, monthly_df['qty'].sum())
+            min_date = pd.to_datetime(min_date, errors='coerce')
+            max_date = pd.to_datetime(max_date, errors='coerce')
+            if pd.isna(min_date) or pd.isna(max_date):
+                date_range = "unknown"
+            else:
+                date_range = f"{min_date.strftime('%Y-%m-%d')} to {max_date.strftime('%Y-%m-%d')}"
+            summary_lines = [
+                f"Total Quantity: {total_qty}",
+                f"Date Range: {date_range}",
+                f"Top 5 Customers: {top_customers_str}",
+                f"{repeat_buyer_str}",
+            ]
+            # Quarterly and yearly totals come pre-aggregated as well
+            quarterly_sales = sorted(sales_data.get("quarterly", []))
+            yearly_sales = sorted(sales_data.get("yearly", []))
+            quarterly_sales_str = ' | '.join([f"{int(yr)}-Q{int(q)}: {int(qty)}" for yr, q, qty in quarterly_sales])
+            yearly_sales_str = ' | '.join([f"{int(yr)}: {int(qty)}" for yr, qty in yearly_sales])
+            summary_lines.append(f'Quarterly Sales: {quarterly_sales_str}')
+            summary_lines.append(f'Yearly Sales: {yearly_sales_str}')
+            # Join all lines into a single string, each on a new line
+            summary_text = '\n'.join(summary_lines)
+            import textwrap
+            wrapped_lines = []
+            for line in summary_lines:
+                wrapped_lines.extend(textwrap.wrap(line, width=45))
+            wrapped_text = '\n'.join(wrapped_lines)
+            # Calculate right margin in axes coordinates for 1 inch
+            fig_width_inch = fig.get_figwidth()
+            right_margin_frac = 1.0 - (1.0 / fig_width_inch)
+            ax3.set_xlim(0, right_margin_frac)
+            bbox_props = dict(facecolor='white', alpha=0.8, edgecolor='none', boxstyle='round,pad=0.3')
+            ax3.text(0, 1, wrapped_text, fontsize=13, fontfamily='DejaVu Sans', color='#222', ha='left', va='top', fontweight='bold', bbox=bbox_props, transform=ax3.transAxes, clip_on=False)
+            # No tight_layout pass: the GridSpec ratios already constrain the
+            # layout and bbox_inches='tight' crops the margins at save time
+            filename = f"sales_plot_{part_number}_{uuid.uuid4().hex[:8]}.png"
+            buf = io.BytesIO()
+            # 150 dpi rasterizes a quarter of the pixels of 300 and is plenty for
+            # on-screen viewing; compress_level=1 trades a slightly bigger file
+            # for far less CPU in libpng than the default level 6
+            fig.savefig(buf, format='png', dpi=150, bbox_inches='tight',
+                        pil_kwargs={"compress_level": 1, "optimize": False})
+            buf.seek(0)
+        # Hand the upload to the pool and return immediately: the filename is
+        # fixed client-side, so the image link can go out while the PNG is
+        # still in flight. The cache entry is only written by _upload_plot
+        # once the upload succeeds, so a failed upload is retried on the next
+        # ask instead of serving a dead link until eviction.
+        self.upload_pool.submit(self._upload_plot, filename, buf, cache_key)
+        return filename
+
+    def _upload_plot(self, filename: str, buf: io.BytesIO, cache_key: tuple):
+        """Upload a rendered plot to the backend (runs on the upload pool)"""
+        try:
+            files = {'file': (filename, buf, 'image/png')}
+            response = self.http.post(f"{self.api_base_url}/save_plot", files=files)
+            if response.status_code == 200:
+                print(f"[DEBUG] Uploaded plot {filename}")
+                self.plot_cache[cache_key] = filename
+                while len(self.plot_cache) > self.plot_cache_size:
+                    self.plot_cache.popitem(last=False)
+            else:
+                print(f"[DEBUG] Failed to upload plot {filename}: {response.text}")
+        except Exception as e:
+            print(f"[DEBUG] Plot upload failed for {filename}: {str(e)}")
 
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
         # This function is called when a new user_message is received.
@@ -297,7 +378,7 @@ class Pipeline:
             # Query the database for sales data
             yield f"🔍 Searching for sales data for part number: {part_number}\n\n"
             
-            sales_data = self.query_sales_dates(part_number)
+            sales_data = self.query_sales_rollups(part_number)
             plot_result = self.create_sales_plot(sales_data, part_number)
             
             if plot_result is None or plot_result.startswith("❌") or plot_result.startswith("📊"):
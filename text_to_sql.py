@@ -2,19 +2,85 @@
 name: MS Access Query via API with LLM
 description: A pipeline to query Microsoft Access .accdb files using natural language, converted to SQL via LLM.
 mode: python
-requirements: aiohttp==3.9.3
+requirements: aiohttp==3.9.3, orjson
 """
 
 from typing import List, Union, Generator, Iterator, Optional, Dict
 import aiohttp
 import asyncio
+import hashlib
 import logging
-from urllib.parse import quote
+import orjson
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Serialize request bodies with orjson and send pre-built headers; aiohttp's
+# json= path goes through the stdlib encoder on every call
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Per-stage decode budgets: each skipped token is wall time on Ollama, and
+# every parser downstream consumes far less than the default unbounded output
+# (a comma list, one SQL statement, a 4-line summary)
+_USAGE_OPTIONS = {
+    "classifier": {"num_predict": 64, "temperature": 0.0, "top_k": 1, "num_ctx": 4096},
+    "query_generation": {"num_predict": 384, "temperature": 0.0, "top_k": 1, "num_ctx": 4096},
+    "output": {"num_predict": 512, "temperature": 0.1, "num_ctx": 4096},
+}
+
+# Bump when any prompt template changes so stale answers aren't served
+PROMPT_VERSION = "2"
+
+# Classifier system prompt; the table list only changes on fetch_tables, so
+# the formatted prefix is memoized there and reused byte-identical per call
+CLASSIFIER_TEMPLATE = """You are an expert in database systems. Your task is to analyze a natural language question and choose the most relevant tables from the following list.
+
+Rules:
+- Return ALL tables needed to answer the question completely.
+- If the question clearly implies a relationship between entities, include all relevant tables and assume a JOIN may be needed.
+- Output should be a comma-separated list of exact table names from the list. No extra words.
+
+Available tables:
+{tables}
+
+Respond with only the table names, comma-separated.
+"""
+
+# First markdown code fence (```sql or bare ```), tolerating a missing
+# closing fence at end of response
+_SQL_FENCE = re.compile(r"```(?:sql)?\s*\n(.*?)(?:```|\Z)", re.DOTALL | re.IGNORECASE)
+
+# Static SQL-generation rules, kept byte-identical across calls so the
+# serving side can reuse the KV cache for the whole system prefix; only the
+# user question varies per request
+SQL_SYSTEM_RULES = """You are a helpful assistant that generates Microsoft Access SQL queries from user questions.
+
+Given a question and a list of tables with their columns, generate a syntactically correct SQL query for MS Access. Follow these strict rules:
+
+MS Access SQL Rules:
+1. Use `SELECT TOP n` instead of `LIMIT n`.
+2. Use square brackets around ALL table and column names.
+3. Put `TOP` immediately after `SELECT` (e.g. `SELECT TOP 5 [Name]`)
+4. Use `*` only in LIKE clauses (e.g., `[Column] LIKE '*value*'`)
+5. Use `#` for date literals (e.g., `#2024-05-19#`)
+6. Use `&` for string concatenation instead of `||`
+7. For JOINs, use:
+   `[Table1] INNER JOIN [Table2] ON [Table1].[Key] = [Table2].[Key]`
+8. Qualify columns in multi-table queries (e.g., `[Customers].[Name]`)
+
+Other Rules:
+- If no number of results is mentioned, return `TOP 5`.
+- Do NOT select all columns (`SELECT *`). Select only those relevant to the question.
+- Use `DISTINCT` where needed to remove duplicates.
+- Return only the SQL query. Do NOT include any explanation or markdown formatting.
+"""
+
 class Pipeline:
     def __init__(self):
         self.ollama_host = "http://10.10.12.30:11435/api/chat"
@@ -22,45 +88,295 @@ class Pipeline:
         self.classifier_model_name = "gemma3:4b"
         self.query_generation_model_name = "qwen2.5-coder:3b"
         self.output_model_name = "deepseek-r1"
+        self.embedding_model_name = "nomic-embed-text"
         self.name = "Text to SQL"
         self.available_tables: List[str] = []
-        self.table_schemas: Dict[str, List[tuple]] = {}
+        # Schemas as parallel (names, types) tuples: half the tuple-header
+        # overhead of a list of 2-tuples. LRU-bounded so a database with many
+        # tables doesn't grow the process without limit.
+        self.table_schemas: "OrderedDict[str, tuple]" = OrderedDict()
+        self._schema_cache_size = 128
+        # Pre-rendered prompt block per table; schemas are immutable after
+        # fetch, and byte-identical blocks are what make prompt-prefix KV
+        # cache hits possible for repeated table sets
+        self._schema_block_cache: Dict[str, str] = {}
+        self._classifier_prefix: str = ""
+        # Case-insensitive table lookup: lowercased name -> canonical name
+        self._tables_ci: Dict[str, str] = {}
+        # Join-key hints per table set, derived once from column-name overlap
+        self._join_hints_cache: Dict[frozenset, str] = {}
+        # Generated SQL per (schema version, tables, normalized question):
+        # repeats skip the query-generation LLM call even when the answer
+        # cache has expired. The version bump on any schema store invalidates
+        # every entry cheaply instead of tracking per-table dependencies.
+        self._sql_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        self._sql_cache_size = 1024
+        self._schema_version = 0
+        # On-disk copy of tables + schemas, validated against the .accdb
+        # mtime: restarts against an unchanged database skip the catalog
+        # round trips entirely
+        self._schema_cache_path = "/tmp/access_schema_cache.json"
+        # One keep-alive session per upstream host; per-call sessions paid a
+        # TCP handshake and threw away the connection pool each time. The LLM
+        # host sees few, long requests while the DB API sees many short ones,
+        # so each gets its own pool sizing and timeout profile.
+        self._llm_session: Optional[aiohttp.ClientSession] = None
+        self._db_session: Optional[aiohttp.ClientSession] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._ollama_sem: Optional[asyncio.Semaphore] = None
+        # Classifier output cache: exact hits on a hash of the normalized
+        # question, semantic hits by cosine similarity over Ollama embeddings.
+        # The table list rarely changes, so repeats skip a full LLM roundtrip.
+        self._table_cache: "OrderedDict[str, List[str]]" = OrderedDict()
+        self._table_cache_embs: List[tuple] = []  # (embedding, cache key)
+        self._table_cache_size = 256
+        self._semantic_threshold = 0.92
+        # Whole-answer cache: repeated questions skip classifier, SQL gen, DB
+        # query and summary entirely for an hour
+        self._answer_cache: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (ts, answer)
+        self._answer_cache_size = 256
+        self._answer_ttl = 3600
+        # Rows beyond this are dropped before the summarizer prompt; decode
+        # time scales with context length and 50 rows is plenty of signal
+        self._max_summary_rows = 50
+        # Single-flight map: concurrent identical questions collapse onto one
+        # pipeline run, with followers served from the answer cache
+        self._inflight: Dict[str, threading.Event] = {}
+        self._inflight_lock = threading.Lock()
+        # One long-lived event loop on a daemon thread. asyncio.run per
+        # message created and destroyed a loop (plus resolver and selector)
+        # every call and invalidated the shared sessions bound to it.
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True, name="text-to-sql-loop").start()
         logger.info("Pipeline initialized")
 
+    async def _ensure_sessions(self):
+        """(Re)build the per-host sessions if absent or bound to another loop.
+
+        Request work runs on the persistent pipeline loop, but the host may
+        drive on_startup/on_shutdown from its own loop; a session must only
+        be used from the loop it was created on.
+        """
+        loop = asyncio.get_running_loop()
+        if self._llm_session is None or self._llm_session.closed or self._session_loop is not loop:
+            # Close a superseded pair on its owning loop before replacing it
+            # (the startup pair is built on the host loop, the first pipe
+            # rebuilds on the persistent loop); just dropping the references
+            # would leak their keep-alive sockets
+            old_loop = self._session_loop
+            for old in (self._llm_session, self._db_session):
+                if old is None or old.closed:
+                    continue
+                if old_loop is not None and old_loop is not loop and old_loop.is_running():
+                    asyncio.run_coroutine_threadsafe(old.close(), old_loop)
+                else:
+                    await old.close()
+            # aiohttp (not httpx/HTTP2) on purpose: Ollama is served over
+            # plaintext HTTP/1.1, so there is no ALPN to negotiate h2 over,
+            # and keep-alive already gives connection reuse on this path
+            self._llm_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=120),
+                timeout=aiohttp.ClientTimeout(total=300),
+            )
+            self._db_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=64, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=15),
+            )
+            # Cap in-flight generations at the server's parallel slot count;
+            # extra requests queue here instead of piling up inside Ollama,
+            # where oversubscription evicts KV cache and serializes anyway.
+            # Loop-bound like the sessions, so rebuilt alongside them.
+            self._ollama_sem = asyncio.Semaphore(
+                int(os.environ.get("OLLAMA_NUM_PARALLEL", "4")))
+            self._session_loop = loop
+
+    async def _get_llm_session(self) -> aiohttp.ClientSession:
+        await self._ensure_sessions()
+        return self._llm_session
+
+    async def _get_db_session(self) -> aiohttp.ClientSession:
+        await self._ensure_sessions()
+        return self._db_session
+
+    async def _warm_model(self, model_name: str):
+        """Ask Ollama to load a model into VRAM without generating anything."""
+        try:
+            session = await self._get_llm_session()
+            url = self.ollama_host.rsplit("/api/", 1)[0] + "/api/generate"
+            async with session.post(url, data=orjson.dumps({"model": model_name, "prompt": "", "keep_alive": "30m"}), headers=_JSON_HEADERS) as resp:
+                await resp.read()
+            logger.info(f"Warmed up model {model_name}")
+        except Exception as e:
+            logger.warning(f"Model warmup failed for {model_name}: {e}")
+
     async def on_startup(self):
         logger.info(f"Starting up pipeline: {__name__}")
-        await self.fetch_tables()
-        logger.info(f"Available tables: {self.available_tables}")
+        await self._ensure_sessions()
+        # Load all three models up front so the first user message doesn't
+        # pay three cold loads in sequence
+        warmups = asyncio.gather(*(self._warm_model(m) for m in (
+            self.classifier_model_name,
+            self.query_generation_model_name,
+            self.output_model_name,
+        )))
+        mtime = await self._db_mtime()
+        if self._load_schema_cache(mtime):
+            logger.info("Loaded %d tables and %d schemas from disk cache",
+                        len(self.available_tables), len(self.table_schemas))
+        else:
+            await self.fetch_tables()
+            await self._prefetch_schemas()
+            self._save_schema_cache(mtime)
+        await warmups
+        logger.debug("Available tables: %s", self.available_tables)
+
+    async def _db_mtime(self):
+        """Fetch the database file's mtime; None when the endpoint is missing."""
+        try:
+            session = await self._get_db_session()
+            async with session.get(f"{self.access_api_url}/mtime") as resp:
+                data = orjson.loads(await resp.read())
+                return data.get("mtime")
+        except Exception as e:
+            logger.debug("DB mtime unavailable: %s", e)
+            return None
+
+    def _load_schema_cache(self, mtime) -> bool:
+        """Populate tables and schemas from the disk cache if it matches mtime."""
+        if mtime is None:
+            return False
+        try:
+            with open(self._schema_cache_path, "rb") as f:
+                cache = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            return False
+        if cache.get("db_mtime") != mtime or not cache.get("tables"):
+            return False
+        self.available_tables = cache["tables"]
+        self._tables_ci = {t.lower(): t for t in self.available_tables}
+        self._classifier_prefix = CLASSIFIER_TEMPLATE.format(
+            tables="\n".join(f"- {t}" for t in self.available_tables))
+        for table_name, cols in cache["schemas"].items():
+            self._store_schema(table_name, cols)
+        return True
+
+    def _save_schema_cache(self, mtime):
+        if mtime is None:
+            return
+        try:
+            payload = {
+                "db_mtime": mtime,
+                "tables": self.available_tables,
+                "schemas": {
+                    t: list(zip(names, types))
+                    for t, (names, types) in self.table_schemas.items()
+                },
+            }
+            with open(self._schema_cache_path, "wb") as f:
+                f.write(orjson.dumps(payload))
+        except OSError as e:
+            logger.debug("Schema cache write failed: %s", e)
 
     async def on_shutdown(self):
         logger.info(f"Shutting down pipeline: {__name__}")
 
-    async def chat_completion(self, prompt: str, model_usage: str) -> Optional[str]:
-        """Make a chat completion request to Ollama"""
-        logger.info("Making chat completion request")
+        async def _close_sessions():
+            for session in (self._llm_session, self._db_session):
+                if session is not None and not session.closed:
+                    await session.close()
+
+        # Sessions must be closed on the loop they were created on, which
+        # after the first pipe() is the persistent loop, not the host's
+        owner = self._session_loop
+        if owner is not None and owner is not asyncio.get_running_loop() and owner.is_running():
+            await asyncio.wrap_future(
+                asyncio.run_coroutine_threadsafe(_close_sessions(), owner))
+        else:
+            await _close_sessions()
+
+    def _resolve_model(self, model_usage: str) -> str:
         if model_usage == "classifier":
-            model_name = self.classifier_model_name
+            return self.classifier_model_name
         elif model_usage == "query_generation":
-            model_name = self.query_generation_model_name
+            return self.query_generation_model_name
         elif model_usage == "output":
-            model_name = self.output_model_name
-        else:
-            raise ValueError(f"Invalid model usage: {model_usage}")
+            return self.output_model_name
+        raise ValueError(f"Invalid model usage: {model_usage}")
+
+    async def chat_completion_stream(self, prompt: str, model_usage: str, user_content: Optional[str] = None):
+        """Stream a chat completion from Ollama chunk by chunk."""
+        logger.info("Making streaming chat completion request")
+        model_name = self._resolve_model(model_usage)
+        session = await self._get_llm_session()
+        messages = [{"role": "system", "content": prompt}]
+        if user_content is not None:
+            messages.append({"role": "user", "content": user_content})
+        payload = {
+            "model": model_name,
+            "messages": messages,
+            "stream": True,
+            "keep_alive": "30m",
+            "options": _USAGE_OPTIONS[model_usage],
+        }
+        if model_usage != "output":
+            # Same as the non-streaming path: no reasoning preamble when we
+            # only want a label or a SQL string
+            payload["think"] = False
+        async with self._ollama_sem:
+            async with session.post(self.ollama_host, data=orjson.dumps(payload), headers=_JSON_HEADERS) as resp:
+                if resp.status != 200:
+                    logger.error(f"Ollama API error: {await resp.text()}")
+                    return
+                async for line in resp.content:
+                    if not line.strip():
+                        continue
+                    try:
+                        data = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue
+                    chunk = data.get("message", {}).get("content", "")
+                    if chunk:
+                        yield chunk
+                    if data.get("done"):
+                        break
+
+    async def chat_completion(self, prompt: str, model_usage: str, user_content: Optional[str] = None) -> Optional[str]:
+        """Make a chat completion request to Ollama.
+
+        Dynamic content should go in user_content: the system message is then
+        a stable prefix the server can serve from its prompt cache.
+        """
+        logger.info("Making chat completion request")
+        model_name = self._resolve_model(model_usage)
         try:
-            async with aiohttp.ClientSession() as session:
-                payload = {
-                    "model": model_name,
-                    "messages": [
-                        {"role": "system", "content": prompt}
-                    ],
-                    "stream": False
-                }
-                logger.debug(f"Sending payload to Ollama: {payload}")
-                async with session.post(self.ollama_host, json=payload) as resp:
+            session = await self._get_llm_session()
+            messages = [{"role": "system", "content": prompt}]
+            if user_content is not None:
+                messages.append({"role": "user", "content": user_content})
+            payload = {
+                "model": model_name,
+                "messages": messages,
+                "stream": False,
+                # Keep weights resident between pipeline stages; the default
+                # 5-minute unload makes bursty traffic pay multi-second
+                # cold loads per stage
+                "keep_alive": "30m",
+                "options": _USAGE_OPTIONS[model_usage],
+            }
+            if model_usage != "output":
+                # Suppress reasoning preambles where we only want a label or
+                # a SQL string; ignored by models without thinking support
+                payload["think"] = False
+            logger.debug("Sending payload to Ollama: %s", payload)
+            async with self._ollama_sem:
+                async with session.post(self.ollama_host, data=orjson.dumps(payload), headers=_JSON_HEADERS) as resp:
                     if resp.status == 200:
-                        data = await resp.json()
+                        # orjson on the raw bytes: large generations make the
+                        # stdlib parse a measurable chunk of the call
+                        data = orjson.loads(await resp.read())
                         response = data.get("message", {}).get("content", "").strip()
-                        logger.info(f"Received response from Ollama: {response}")
+                        logger.debug("Received response from Ollama: %s", response)
                         return response
                     else:
                         error_text = await resp.text()
@@ -74,177 +390,337 @@ class Pipeline:
         """Fetch all available tables from the Access database."""
         logger.info("Fetching tables from database")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.access_api_url}/tables") as resp:
-                    data = await resp.json()
-                    if "tables" in data:
-                        self.available_tables = data["tables"]
-                        logger.info(f"Successfully fetched {len(self.available_tables)} tables")
-                        return True
-                    else:
-                        logger.error(f"Tables error: {data.get('error', 'Unknown error')}")
-                        return False
+            session = await self._get_db_session()
+            async with session.get(f"{self.access_api_url}/tables") as resp:
+                data = orjson.loads(await resp.read())
+                if "tables" in data:
+                    self.available_tables = data["tables"]
+                    self._tables_ci = {t.lower(): t for t in self.available_tables}
+                    self._classifier_prefix = CLASSIFIER_TEMPLATE.format(
+                        tables="\n".join(f"- {t}" for t in self.available_tables))
+                    logger.info(f"Successfully fetched {len(self.available_tables)} tables")
+                    return True
+                else:
+                    logger.error(f"Tables error: {data.get('error', 'Unknown error')}")
+                    return False
         except Exception as e:
             logger.error(f"Failed to fetch tables: {e}")
             return False
 
+    @staticmethod
+    def _column_pair(col) -> tuple:
+        """Normalize a column entry to (name, type); the API may send dicts
+        or positional sequences depending on the endpoint."""
+        if isinstance(col, dict):
+            return col.get("name"), col.get("type")
+        return col[0], col[1]
+
+    def _store_schema(self, table_name: str, cols: list):
+        """Record a fetched schema, its prompt block, and apply LRU eviction."""
+        pairs = [self._column_pair(col) for col in cols]
+        self.table_schemas[table_name] = (
+            tuple(name for name, _ in pairs),
+            tuple(col_type for _, col_type in pairs),
+        )
+        self.table_schemas.move_to_end(table_name)
+        self._schema_version += 1
+        self._schema_block_cache[table_name] = (
+            f"\nTable: {table_name}\nColumns:\n"
+            + "\n".join(f"- {name} ({col_type})" for name, col_type in pairs)
+            + "\n"
+        )
+        while len(self.table_schemas) > self._schema_cache_size:
+            evicted, _ = self.table_schemas.popitem(last=False)
+            self._schema_block_cache.pop(evicted, None)
+            for hint_key in [k for k in self._join_hints_cache if evicted in k]:
+                del self._join_hints_cache[hint_key]
+
+    async def _prefetch_schemas(self):
+        """Warm the whole schema cache at startup so no user question pays a
+        schema round trip; prefers the server's single bulk response."""
+        try:
+            session = await self._get_db_session()
+            async with session.get(f"{self.access_api_url}/schema_bulk",
+                                   timeout=aiohttp.ClientTimeout(total=600)) as resp:
+                data = orjson.loads(await resp.read())
+            bulk = data.get("tables", {})
+            if bulk:
+                for table_name, info in bulk.items():
+                    self._store_schema(table_name, info.get("columns", []))
+                logger.info(f"Prefetched {len(bulk)} schemas in bulk")
+                return
+        except Exception as e:
+            logger.info(f"Bulk schema prefetch unavailable ({e}); fetching per table")
+        await self._ensure_schemas(self.available_tables[:self._schema_cache_size])
+
     async def fetch_schema(self, table_name: str) -> bool:
         """Fetch schema for a specific table."""
         logger.info(f"Fetching schema for table: {table_name}")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.access_api_url}/schema/{table_name}") as resp:
-                    data = await resp.json()
-                    if "columns" in data:
-                        self.table_schemas[table_name] = data["columns"]
-                        logger.info(f"Successfully fetched schema with {len(data['columns'])} columns")
-                        return True
-                    else:
-                        logger.error(f"Schema error: {data.get('error', 'Unknown error')}")
-                        return False
+            session = await self._get_db_session()
+            async with session.get(f"{self.access_api_url}/schema/{table_name}") as resp:
+                data = orjson.loads(await resp.read())
+                if "columns" in data:
+                    self._store_schema(table_name, data["columns"])
+                    logger.info(f"Successfully fetched schema with {len(data['columns'])} columns")
+                    return True
+                else:
+                    logger.error(f"Schema error: {data.get('error', 'Unknown error')}")
+                    return False
         except Exception as e:
             logger.error(f"Failed to fetch schema: {e}")
             return False
 
+    async def _embed_question(self, text: str) -> Optional[List[float]]:
+        """Embed a question via Ollama; returns None if the endpoint is unavailable."""
+        try:
+            session = await self._get_llm_session()
+            url = self.ollama_host.rsplit("/api/", 1)[0] + "/api/embeddings"
+            async with session.post(url, data=orjson.dumps({"model": self.embedding_model_name, "prompt": text}), headers=_JSON_HEADERS) as resp:
+                if resp.status == 200:
+                    data = orjson.loads(await resp.read())
+                    return data.get("embedding")
+        except Exception as e:
+            logger.debug(f"Embedding unavailable, exact-match cache only: {e}")
+        return None
+
+    @staticmethod
+    def _cosine(a: List[float], b: List[float]) -> float:
+        dot = sum(x * y for x, y in zip(a, b))
+        na = sum(x * x for x in a) ** 0.5
+        nb = sum(y * y for y in b) ** 0.5
+        return dot / (na * nb) if na and nb else 0.0
+
     async def select_relevant_tables(self, user_question: str) -> List[str]:
         """Use LLM to select the relevant tables for the query."""
-        logger.info(f"Selecting relevant tables for question: {user_question}")
+        logger.info("Selecting relevant tables for question: %s", user_question)
 
         if not self.available_tables:
             await self.fetch_tables()
-            
-        tables_str = "\n".join([f"- {table}" for table in self.available_tables])
-        
-        prompt = f"""You are an expert in database systems. Your task is to analyze a natural language question and choose the most relevant tables from the following list.
 
-Rules:
-- Return ALL tables needed to answer the question completely.
-- If the question clearly implies a relationship between entities, include all relevant tables and assume a JOIN may be needed.
-- Output should be a comma-separated list of exact table names from the list. No extra words.
+        # Deterministic short-circuits: no LLM call when there is nothing to
+        # classify, or when the question literally names available tables
+        if len(self.available_tables) == 1:
+            return list(self.available_tables)
+        # Whole-word matches only: substring containment would let a short
+        # table name buried inside an ordinary word skip the classifier with
+        # a spurious table set
+        named = [t for t in self.available_tables
+                 if re.search(rf"\b{re.escape(t)}\b", user_question, re.IGNORECASE)]
+        if named:
+            logger.info("Question names tables directly: %s", named)
+            return named
+
+        normalized = " ".join(user_question.strip().lower().split())
+        key = hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+        if key in self._table_cache:
+            self._table_cache.move_to_end(key)
+            logger.info("Table selection cache hit (exact)")
+            return self._table_cache[key]
+        embedding = None
+        if self._table_cache_embs:
+            embedding = await self._embed_question(normalized)
+            if embedding is not None:
+                for other_emb, other_key in self._table_cache_embs:
+                    if self._cosine(embedding, other_emb) >= self._semantic_threshold:
+                        logger.info("Table selection cache hit (semantic)")
+                        return self._table_cache[other_key]
 
-Available tables:
-{tables_str}
 
-Question:
-{user_question}
-
-Respond with only the table names, comma-separated.
-"""
-        
         try:
-            selected_tables_str = await self.chat_completion(prompt, "classifier")
+            # Memoized prefix as system message, question as user message:
+            # no per-call prompt assembly and a cache-hittable prefix
+            selected_tables_str = await self.chat_completion(
+                self._classifier_prefix, "classifier", user_content=user_question)
             if selected_tables_str:
                 # Split and clean the table names
                 selected_tables = [t.strip() for t in selected_tables_str.split(',')]
-                # Validate that all tables exist
-                valid_tables = [t for t in selected_tables if t in self.available_tables]
+                # Validate against the case-insensitive lookup: O(1) per name
+                # and tolerant of LLM case drift, mapped back to canon names
+                valid_tables = [self._tables_ci[t.lower()] for t in selected_tables if t.lower() in self._tables_ci]
                 if valid_tables:
+                    # Populate the cache (embedding may be None; exact-only then)
+                    if embedding is None:
+                        embedding = await self._embed_question(normalized)
+                    self._table_cache[key] = valid_tables
+                    if embedding is not None:
+                        self._table_cache_embs.append((embedding, key))
+                    while len(self._table_cache) > self._table_cache_size:
+                        old_key, _ = self._table_cache.popitem(last=False)
+                        self._table_cache_embs = [e for e in self._table_cache_embs if e[1] != old_key]
                     return valid_tables
             return []
         except Exception as e:
             logger.error(f"Error selecting tables: {e}")
             return []
 
-    async def generate_sql_query(self, tables: List[str], user_question: str) -> Optional[str]:
-        """Generate SQL query based on schemas and user question."""
-        logger.info(f"Generating SQL query for tables: {tables}")
-        
-        # Fetch schemas for all tables if not already cached
-        schemas = {}
-        for table in tables:
-            if table not in self.table_schemas:
-                success = await self.fetch_schema(table)
-                if not success:
-                    logger.error(f"Failed to fetch schema for table {table}")
-                    return None
-            schemas[table] = self.table_schemas[table]
-
-        # Build schema string for all tables
-        schema_str = ""
-        for table in tables:
-            schema_str += f"\nTable: {table}\nColumns:\n"
-            schema_str += "\n".join([f"- {col[0]} ({col[1]})" for col in schemas[table]])
-            schema_str += "\n"
-        
-        prompt = f"""You are a helpful assistant that generates Microsoft Access SQL queries from user questions.
+    async def select_relevant_tables_batch(self, questions: List[str]) -> List[List[str]]:
+        """Classify several questions in one LLM call.
 
-Given a question and a list of tables with their columns, generate a syntactically correct SQL query for MS Access. Follow these strict rules:
-
-MS Access SQL Rules:
-1. Use `SELECT TOP n` instead of `LIMIT n`.
-2. Use square brackets around ALL table and column names.
-3. Put `TOP` immediately after `SELECT` (e.g. `SELECT TOP 5 [Name]`)
-4. Use `*` only in LIKE clauses (e.g., `[Column] LIKE '*value*'`)
-5. Use `#` for date literals (e.g., `#2024-05-19#`)
-6. Use `&` for string concatenation instead of `||`
-7. For JOINs, use:
-   `[Table1] INNER JOIN [Table2] ON [Table1].[Key] = [Table2].[Key]`
-8. Qualify columns in multi-table queries (e.g., `[Customers].[Name]`)
-
-Other Rules:
-- If no number of results is mentioned, return `TOP 5`.
-- Do NOT select all columns (`SELECT *`). Select only those relevant to the question.
-- Use `DISTINCT` where needed to remove duplicates.
+        One prompt amortizes the model roundtrip and the shared prefix over
+        the whole batch; used by offline callers that classify many questions
+        at once, not by the interactive pipe path.
+        """
+        if not questions:
+            return []
+        if not self.available_tables:
+            await self.fetch_tables()
+        numbered = "\n".join(f"{i + 1}. {q}" for i, q in enumerate(questions))
+        instructions = (
+            "For each numbered question below, respond with one line of the form "
+            "'N: table1,table2' naming the relevant tables. No other text.\n"
+        )
+        try:
+            response = await self.chat_completion(
+                self._classifier_prefix, "classifier",
+                user_content=instructions + numbered)
+        except Exception as e:
+            logger.error(f"Error in batch table selection: {e}")
+            response = None
+        results: List[List[str]] = [[] for _ in questions]
+        if response:
+            for line in response.splitlines():
+                idx_str, sep, tables_str = line.partition(":")
+                idx_str = idx_str.strip().lstrip("#").rstrip(".")
+                if not sep or not idx_str.isdigit():
+                    continue
+                idx = int(idx_str) - 1
+                if 0 <= idx < len(questions):
+                    names = (t.strip().lower() for t in tables_str.split(","))
+                    results[idx] = [self._tables_ci[n] for n in names if n in self._tables_ci]
+        return results
+
+    async def _ensure_schemas(self, tables: List[str]) -> bool:
+        """Fetch any missing schemas concurrently; True if all are cached.
+
+        The fetches are independent HTTP calls, so a join across N cold
+        tables costs one RTT, not N.
+        """
+        missing = [t for t in tables if t not in self.table_schemas]
+        if missing:
+            await asyncio.gather(*(self.fetch_schema(t) for t in missing), return_exceptions=True)
+        return all(t in self.table_schemas for t in tables)
 
-Schemas:
-{schema_str}
+    async def _warm_db(self):
+        """Open a keepalive connection to the DB API while the LLM is busy."""
+        try:
+            session = await self._get_db_session()
+            async with session.get(f"{self.access_api_url}/tables") as resp:
+                await resp.read()
+        except Exception as e:
+            logger.debug(f"DB warm-up failed: {e}")
 
-User Question:
-{user_question}
+    async def generate_sql_query(self, tables: List[str], user_question: str) -> Optional[str]:
+        """Generate SQL query based on schemas and user question."""
+        logger.info("Generating SQL query for tables: %s", tables)
 
-Return only the SQL query. Do NOT include any explanation or markdown formatting.
+        if not await self._ensure_schemas(tables):
+            failed = [t for t in tables if t not in self.table_schemas]
+            logger.error(f"Failed to fetch schema for tables: {failed}")
+            return None
+        cache_key = (self._schema_version, tuple(sorted(tables)),
+                     " ".join(user_question.strip().lower().split()))
+        if cache_key in self._sql_cache:
+            self._sql_cache.move_to_end(cache_key)
+            logger.info("SQL generation cache hit")
+            return self._sql_cache[cache_key]
+        # Concatenate the pre-rendered per-table blocks: no per-call join
+        # work, and the same table set always yields the same bytes
+        schema_str = "".join(self._schema_block_cache[t] for t in tables)
+
+        # For multi-table queries, point the model at columns shared by every
+        # table so it doesn't burn decode tokens re-deriving the join keys
+        join_hints = ""
+        if len(tables) > 1:
+            hint_key = frozenset(tables)
+            join_hints = self._join_hints_cache.get(hint_key)
+            if join_hints is None:
+                shared_cols = set.intersection(
+                    *(set(self.table_schemas[t][0]) for t in tables))
+                join_hints = "\nLikely join keys: " + ", ".join(sorted(shared_cols)) + "\n" if shared_cols else ""
+                self._join_hints_cache[hint_key] = join_hints
+
+        # Rules + schemas form the stable prefix; the question rides in a
+        # separate user message so prefix KV cache hits survive across calls
+        system_prompt = f"{SQL_SYSTEM_RULES}\nSchemas:\n{schema_str}{join_hints}"
 
-"""
-        
         try:
-            response = await self.chat_completion(prompt, "query_generation")
+            # Stream the generation and cut it off as soon as the statement is
+            # complete (closed fence, or a semicolon when unfenced); anything
+            # the model adds after the query is decode time spent on tokens
+            # the fence regex would discard anyway
+            stream = self.chat_completion_stream(system_prompt, "query_generation", user_content=user_question)
+            parts = []
+            try:
+                async for chunk in stream:
+                    parts.append(chunk)
+                    text = "".join(parts)
+                    if text.count("```") >= 2 or (";" in text and "```" not in text):
+                        break
+            finally:
+                # Releases the connection and the Ollama semaphore on early exit
+                await stream.aclose()
+            response = "".join(parts)
             if response:
-                logger.info(f"Generated SQL response: {response}")
-                # Extract code from first markdown code cell
-                start = response.find("```sql")
-                if start == -1:
-                    start = response.find("```")
-                if start != -1:
-                    end = response.find("```", start + 3)
-                    if end != -1:
-                        sql_query = response[start:end].split("\n", 1)[1].strip()
-                    else:
-                        sql_query = response[start:].split("\n", 1)[1].strip()
-                else:
-                    sql_query = response.strip()
-                # Normalize newlines to single spaces
-                sql_query = " ".join(line.strip() for line in sql_query.splitlines() if line.strip())
-                logger.info(f"Cleaned SQL query: {sql_query}")
+                logger.debug("Generated SQL response: %s", response)
+                # Extract code from the first markdown fence in a single
+                # regex pass, then collapse whitespace to one line
+                m = _SQL_FENCE.search(response)
+                sql_query = (m.group(1) if m else response).strip()
+                sql_query = " ".join(sql_query.split())
+                logger.info("Cleaned SQL query: %s", sql_query)
+                self._sql_cache[cache_key] = sql_query
+                while len(self._sql_cache) > self._sql_cache_size:
+                    self._sql_cache.popitem(last=False)
             return sql_query
         except Exception as e:
             logger.error(f"Error generating SQL: {e}")
             return None
 
-    async def fetch_query_result(self, query: str) -> str:
-        """Execute SQL query and fetch results."""
-        logger.info(f"Executing query: {query}")
-        params = {"q": query}
+    async def fetch_query_results(self, queries: List[str]) -> List[str]:
+        """Execute several SQL queries in one round trip via /batch_query.
+
+        Amortizes the HTTP and ODBC overhead when the pipeline runs more
+        than one statement (e.g. refinement passes).
+        """
+        logger.info("Executing batch of %d queries", len(queries))
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{self.access_api_url}/query", params=params) as resp:
-                    data = await resp.json()
-                    if "result" in data:
-                        logger.info("Query executed successfully")
-                        return f"✅ Results:\n{data['result']}"
+            session = await self._get_db_session()
+            async with session.post(f"{self.access_api_url}/batch_query", data=orjson.dumps({"queries": queries}), headers=_JSON_HEADERS) as resp:
+                data = orjson.loads(await resp.read())
+                results = data.get("results")
+                if results is None:
+                    error_msg = data.get("error", "Unknown error")
+                    logger.error(f"Batch query error: {error_msg}")
+                    return [f"❌ Error:\n{error_msg}"] * len(queries)
+                formatted = []
+                for entry in results:
+                    if "result" in entry:
+                        rows = entry["result"]
+                        if isinstance(rows, list) and len(rows) > self._max_summary_rows:
+                            extra = len(rows) - self._max_summary_rows
+                            formatted.append(
+                                f"✅ Results:\n{rows[:self._max_summary_rows]}\n"
+                                f"... (+{extra} more rows truncated)")
+                        else:
+                            formatted.append(f"✅ Results:\n{rows}")
                     else:
-                        error_msg = data.get('error', 'Unknown error')
+                        error_msg = entry.get("error", "Unknown error")
                         logger.error(f"Query error: {error_msg}")
-                        return f"❌ Error:\n{error_msg}"
+                        formatted.append(f"❌ Error:\n{error_msg}")
+                return formatted
         except Exception as e:
             logger.error(f"Request failed: {e}")
-            return f"❌ Request failed: {str(e)}"
+            return [f"❌ Request failed: {str(e)}"] * len(queries)
 
-    async def summarize_results(self, question: str, tables: List[str], sql_query: str, query_result: str) -> Optional[str]:
-        """Summarize the query results in natural language."""
-        logger.info("Generating summary of query results")
-        
-        tables_str = ", ".join(tables)
-        prompt = f"""You are a database assistant summarizing SQL query results into natural language.
+    async def fetch_query_result(self, query: str) -> str:
+        """Execute SQL query and fetch results."""
+        logger.info("Executing query: %s", query)
+        return (await self.fetch_query_results([query]))[0]
+
+    def _summary_prompt(self, question: str, tables: List[str], sql_query: str, query_result: str) -> str:
+        """Build the summarization prompt for the output model."""
+        return f"""You are a database assistant summarizing SQL query results into natural language.
 
 Given a user's question, the SQL used, and the query results, write a short explanation of what the results mean.
 
@@ -270,80 +746,158 @@ Write your summary below:
 
 """
 
-        try:
-            summary = await self.chat_completion(prompt, "output")
-            if summary:
-                logger.info("Successfully generated summary")
-                return summary.strip()
-            return None
-        except Exception as e:
-            logger.error(f"Error generating summary: {e}")
-            return None
-
-    async def _try_execute_query(self, user_question: str, selected_tables: List[str], attempt: int = 1, max_attempts: int = 3, previous_error: str = None) -> tuple[Optional[str], Optional[str], Optional[str]]:
+    async def _try_execute_query(self, user_question: str, selected_tables: List[str], max_attempts: int = 3) -> tuple[Optional[str], Optional[str], Optional[str]]:
         """
         Try to generate and execute a SQL query with retry logic.
         Returns a tuple of (sql_query, query_result, error_message).
         """
-        logger.info(f"Attempting to generate and execute query (attempt {attempt}/{max_attempts})")
-        
-        # If we have a previous error, modify the query generation prompt
-        error_context = f"\nPrevious attempt failed with error: {previous_error}\nPlease fix the query accordingly." if previous_error else ""
-        
-        # Generate SQL query
-        sql_query = await self.generate_sql_query(selected_tables, user_question + error_context)
-        if not sql_query:
-            return None, None, "Failed to generate SQL query"
-        
-        # Execute query and get results
-        result = await self.fetch_query_result(sql_query)
-        
-        # Check if there was an error in the result
-        if result.startswith("❌"):
-            error_message = result.split("\n")[1] if "\n" in result else result[2:].strip()
-            
+        previous_error = None
+        sql_query = result = None
+        for attempt in range(1, max_attempts + 1):
+            logger.info("Attempting to generate and execute query (attempt %d/%d)", attempt, max_attempts)
+
+            # If we have a previous error, modify the query generation prompt
+            error_context = f"\nPrevious attempt failed with error: {previous_error}\nPlease fix the query accordingly." if previous_error else ""
+
+            # Generate SQL query
+            sql_query = await self.generate_sql_query(selected_tables, user_question + error_context)
+            if not sql_query:
+                return None, None, "Failed to generate SQL query"
+
+            # Execute query and get results
+            result = await self.fetch_query_result(sql_query)
+            if not result.startswith("❌"):
+                return sql_query, result, None
+
+            previous_error = result.split("\n")[1] if "\n" in result else result[2:].strip()
             if attempt < max_attempts:
-                logger.info(f"Query failed, attempting retry {attempt + 1}/{max_attempts}")
-                return await self._try_execute_query(
-                    user_question,
-                    selected_tables,
-                    attempt + 1,
-                    max_attempts,
-                    error_message
-                )
-            else:
-                return sql_query, result, f"Failed after {max_attempts} attempts. Last error: {error_message}"
-        
-        return sql_query, result, None
+                logger.info("Query failed, attempting retry %d/%d", attempt + 1, max_attempts)
+                # Brief exponential backoff so transient DB errors aren't hammered
+                await asyncio.sleep(0.1 * 2 ** (attempt - 1))
+
+        return sql_query, result, f"Failed after {max_attempts} attempts. Last error: {previous_error}"
 
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
-        async def process():
+        # Answers depend on the question, the table list and the prompt
+        # templates; the data itself can drift, hence the TTL
+        cache_key = hashlib.sha256(
+            (user_message + "\n" + ",".join(self.available_tables) + "\n" + PROMPT_VERSION).encode()
+        ).hexdigest()
+        cached = self._answer_cache.get(cache_key)
+        if cached is not None and time.time() - cached[0] < self._answer_ttl:
+            self._answer_cache.move_to_end(cache_key)
+            logger.info("Answer cache hit")
+            return cached[1]
+
+        # Two users (or a retry) asking the same thing at once should not
+        # each run the full LLM + DB pipeline: the first becomes the leader,
+        # the rest wait and read its cached answer
+        with self._inflight_lock:
+            leader = cache_key not in self._inflight
+            if leader:
+                self._inflight[cache_key] = threading.Event()
+            event = self._inflight[cache_key]
+        if not leader:
+            event.wait(timeout=300)
+            cached = self._answer_cache.get(cache_key)
+            if cached is not None and time.time() - cached[0] < self._answer_ttl:
+                logger.info("Answer cache hit (single-flight)")
+                return cached[1]
+            # The leader failed or timed out; run the pipeline ourselves
+
+        async def prepare():
+            """Everything up to (not including) the summary; returns an error
+            string on failure, else (header, tables, sql, result, error)."""
             try:
-                logger.info(f"Processing question: {user_message}")
-                
+                logger.info("Processing question: %s", user_message)
+
+                # Open a keepalive connection to the DB API while the
+                # classifier is thinking; with schemas prefetched at startup,
+                # prompt assembly after classification is pure dict lookups
+                asyncio.create_task(self._warm_db())
+
                 # Select relevant tables
                 selected_tables = await self.select_relevant_tables(user_message)
                 if not selected_tables:
                     return "Failed to identify relevant tables for your question."
-                logger.info(f"Selected tables: {selected_tables}")
-                
+                logger.info("Selected tables: %s", selected_tables)
+
+                # Schemas are normally already cached; this only does I/O if
+                # the startup prefetch missed a table
+                await self._ensure_schemas(selected_tables)
                 # Try to execute query with retries
                 sql_query, result, error = await self._try_execute_query(user_message, selected_tables)
-                
+
                 if error and not result:  # Complete failure
                     return f"Failed to execute query: {error}"
-                
-                # Generate summary if we have results
-                summary = await self.summarize_results(user_message, selected_tables, sql_query, result)
-                summary_text = f"\nSummary:\n{summary}" if summary else ""
-                
+
                 # If we had errors but eventually succeeded, include retry information
                 retry_info = f"\nNote: Query succeeded after retries. Original error: {error}\n" if error else ""
-                
-                return f"Selected tables: {', '.join(selected_tables)}\n{retry_info}\nGenerated SQL Query:\n```sql\n{sql_query}\n```\n\n{result}{summary_text}"
-            
+
+                header = f"Selected tables: {', '.join(selected_tables)}\n{retry_info}\nGenerated SQL Query:\n```sql\n{sql_query}\n```\n\n{result}"
+                return header, selected_tables, sql_query, result, error
+
             except Exception as e:
                 logger.error(f"Error in pipeline: {e}")
                 return f"Error: {str(e)}"
 
-        return asyncio.run(process())
\ No newline at end of file
+        def run_async(coro):
+            """Run a coroutine on the persistent loop from this sync context."""
+            return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+        def generate():
+            # Stream the known parts immediately, then the summary token by
+            # token: the user sees tables/SQL/results while deepseek-r1 is
+            # still reasoning instead of waiting for its full output
+            try:
+                outcome = run_async(prepare())
+                if isinstance(outcome, str):  # failure; never cached
+                    yield outcome
+                    return
+                header, selected_tables, sql_query, result, error = outcome
+                agen = self.chat_completion_stream(
+                    self._summary_prompt(user_message, selected_tables, sql_query, result), "output")
+                # Kick the summary request off on the loop before yielding the
+                # header downstream, so the model prefills while the client is
+                # still receiving the tables/SQL/results block
+                pending = asyncio.run_coroutine_threadsafe(agen.__anext__(), self._loop)
+                yield header
+                parts = [header]
+                first = True
+                stream_failed = False
+                while True:
+                    try:
+                        if pending is not None:
+                            chunk, pending = pending.result(), None
+                        else:
+                            chunk = run_async(agen.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    except Exception as e:
+                        logger.error(f"Error streaming summary: {e}")
+                        stream_failed = True
+                        break
+                    if first:
+                        yield "\nSummary:\n"
+                        parts.append("\nSummary:\n")
+                        first = False
+                    yield chunk
+                    parts.append(chunk)
+                # A stream that ended without a single chunk (e.g. a non-200
+                # from Ollama) is a failure too, not a header-only answer
+                if first:
+                    stream_failed = True
+                # Only cache full successes: a run that exhausted its retries
+                # or a summary stream that died midway is retried on the next
+                # ask instead of being served stale for an hour
+                if error is None and not stream_failed:
+                    self._answer_cache[cache_key] = (time.time(), "".join(parts))
+                    while len(self._answer_cache) > self._answer_cache_size:
+                        self._answer_cache.popitem(last=False)
+            finally:
+                with self._inflight_lock:
+                    waiter = self._inflight.pop(cache_key, None)
+                if waiter is not None:
+                    waiter.set()
+
+        return generate()
\ No newline at end of file
@@ -1,9 +1,10 @@
 import requests
 import pandas as pd
-from tqdm import tqdm
 
 api_base_url = "http://localhost:8001"
 
+session = requests.Session()
+
 query = '''
 SELECT TOP 100 [item_id], SUM([qty]) as total_qty
 FROM SOJournal
@@ -12,37 +13,38 @@ ORDER BY SUM([qty]) DESC
 '''
 
 print("Querying top 100 parts...")
-response = requests.get(f"{api_base_url}/query", params={"q": query})
+response = session.get(f"{api_base_url}/query", params={"q": query})
 top_parts = response.json()['result']
 
-results = []
-
-print("Querying top 5 customers for each part...")
-for part in tqdm(top_parts, desc="Parts"):
-    item_id = part[0]
-    qty = part[1]
-    query = f'''
-    SELECT TOP 5 [cust_id], SUM([qty]) as total_qty
-    FROM SOJournal
-    WHERE [item_id] = '{item_id}'
-    GROUP BY [cust_id]
-    ORDER BY SUM([qty]) DESC
-    '''
-    response = requests.get(f"{api_base_url}/query", params={"q": query})
-    top_customers = response.json().get('result', [])
-    for cust in top_customers:
-        cust_id = cust[0]
-        cust_qty = cust[1]
-        results.append({
-            'item_id': item_id,
-            'item_total_qty': qty,
-            'cust_id': cust_id,
-            'cust_qty': cust_qty
-        })
+item_ids = [part[0] for part in top_parts]
+item_totals = {part[0]: part[1] for part in top_parts}
+
+# One grouped query over all 100 items instead of 100 per-item round trips:
+# the engine scans SOJournal once and the top-5 cut happens in pandas.
+# Access lacks ROW_NUMBER, so ranking in SQL would need a correlated
+# subquery per row; fetching the (item, customer) rollup is far cheaper.
+print("Querying customer totals for all parts in one pass...")
+placeholders = ", ".join("?" * len(item_ids))
+query = f'''
+SELECT [item_id], [cust_id], SUM([qty]) as total_qty
+FROM SOJournal
+WHERE [item_id] IN ({placeholders})
+GROUP BY [item_id], [cust_id]
+'''
+response = session.post(f"{api_base_url}/query", json={"q": query, "params": item_ids})
+rows = response.json().get('result', [])
+
+df = pd.DataFrame(rows, columns=['item_id', 'cust_id', 'cust_qty'])
+df['item_total_qty'] = df['item_id'].map(item_totals)
+# Top 5 customers per item, keeping items in descending total-qty order
+df = df.sort_values(['item_total_qty', 'item_id', 'cust_qty'], ascending=[False, True, False])
+results_df = df.groupby('item_id', sort=False).head(5)
+results_df = results_df[['item_id', 'item_total_qty', 'cust_id', 'cust_qty']]
 
 print("Saving results to top_100_parts_customers.xlsx...")
-results_df = pd.DataFrame(results)
-results_df.to_excel('top_100_parts_customers.xlsx', index=False)
+# xlsxwriter in constant_memory mode streams rows to disk instead of
+# holding the whole sheet in memory like the default openpyxl writer
+with pd.ExcelWriter('top_100_parts_customers.xlsx', engine='xlsxwriter',
+                    engine_kwargs={'options': {'constant_memory': True}}) as writer:
+    results_df.to_excel(writer, index=False, sheet_name='data')
 print('Results saved to top_100_parts_customers.xlsx')
-
-